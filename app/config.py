@@ -10,6 +10,8 @@ class Settings(BaseSettings):
 
     # Database
     db_path: str = Field(default="./data/resolver.sqlite3", alias="DB_PATH")
+    # Worker threads (each with its own SQLite connection) for blocking DB calls
+    db_pool_size: int = Field(default=4, alias="DB_POOL_SIZE")
 
     # LLM (optional)
     use_llm_env: bool = Field(default=False, alias="USE_LLM")
@@ -25,6 +27,9 @@ class Settings(BaseSettings):
     # Payments security
     invoice_secret: str = Field(default="", alias="INVOICE_SECRET")
 
+    # Seconds group settings/subscription reads are cached in-process; 0 disables the cache
+    group_cache_ttl: int = Field(default=60, alias="GROUP_CACHE_TTL")
+
     # Feature flags
     feature_v2_personal: bool = Field(default=False, alias="FEATURE_V2_PERSONAL")
     feature_v2_groups: bool = Field(default=False, alias="FEATURE_V2_GROUPS")
@@ -1,13 +1,19 @@
-import json
+import asyncio
 import logging
 import os
 import sqlite3
+import threading
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from datetime import date, datetime
-from typing import Optional, Dict, Any, List
+from functools import partial
+from typing import Optional, Dict, Any, List, NamedTuple, Tuple
 
+from cachetools import TTLCache
+
+from . import jsonutil
 from .config import settings
 
 logger = logging.getLogger(__name__)
@@ -158,11 +164,107 @@ CREATE TABLE IF NOT EXISTS audit_embeddings (
 );
 """
 
+_SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+# Per-connection prepared statement cache; the stdlib default of 128 is shared by ~150 queries.
+SQLITE_CACHED_STATEMENTS = 256
+_AUDIT_EVENT_INSERT = """
+INSERT INTO audit_events
+(event_id, ts, chat_id, actor_user_id, target_user_id, action, reason, metadata_json)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+USER_SETTING_FIELDS = frozenset({"default_goal", "default_style", "language", "language_mode", "v2_enabled"})
+
+GROUP_DEFAULTS: Dict[str, Any] = {
+    "enabled": 0,
+    "language": "en",
+    "language_mode": "clean",
+    "warn_threshold": 2,
+    "mute_threshold": 3,
+    "welcome_enabled": 0,
+    "welcome_text": "",
+    "rules_enabled": 0,
+    "rules_text": "",
+    "security_enabled": 0,
+    "security_config_json": "{}",
+}
+
+
+def _apply_group_defaults(group: Dict[str, Any]) -> Dict[str, Any]:
+    for key, value in GROUP_DEFAULTS.items():
+        if group.get(key) is None:
+            group[key] = value
+    return group
+
+
+# Stands in for a lifetime subscription (NULL end_ts) in subscription_expires.
+_NO_EXPIRY = 1 << 62
+_MISSING = object()
+
+
+class GroupConfig(NamedTuple):
+    """Moderation settings for an enabled group."""
+
+    language: str = "en"
+    language_mode: str = "clean"
+    warn_threshold: int = 2
+    mute_threshold: int = 3
+    security_enabled: bool = False
+    subscription_expires: int = 0
+
+    @property
+    def subscription_active(self) -> bool:
+        return self.subscription_expires > int(datetime.utcnow().timestamp())
+
+
+def _account_age_days(created_at: Any, user_id: int) -> int:
+    if not created_at:
+        return 0
+    try:
+        created = datetime.strptime(str(created_at), "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        try:
+            created = datetime.fromisoformat(str(created_at).replace("Z", "+00:00"))
+        except ValueError:
+            logger.warning("Could not parse created_at for user %s", user_id)
+            return 0
+    return max(0, (datetime.utcnow() - created).days)
+
+
+def _subscription_info(
+    status: Optional[str], end_ts: Optional[int], plan_id: Optional[str], now: int
+) -> Dict[str, Any]:
+    active = status == "active" and (end_ts is None or end_ts > now)
+    return {"active": active, "end_ts": end_ts, "plan_id": plan_id}
+
+
+def _still_active(info: Dict[str, Any], now: int) -> Dict[str, Any]:
+    # Copy of a cached _subscription_info with "active" re-checked against the current time.
+    end_ts = info["end_ts"]
+    return {**info, "active": info["active"] and (end_ts is None or end_ts > now)}
+
 
 class DB:
     def __init__(self, path: Optional[str] = None):
         self.path = path or settings.db_path
         self._initialized = False
+        # Group reads cached for GROUP_CACHE_TTL seconds and dropped on group writes; 0 disables them.
+        ttl = settings.group_cache_ttl
+        self._group_configs: Optional[TTLCache] = TTLCache(maxsize=4096, ttl=ttl) if ttl > 0 else None
+        self._group_bundles: Optional[TTLCache] = TTLCache(maxsize=4096, ttl=ttl) if ttl > 0 else None
+        # cachetools caches are not thread-safe and writes may now run on DB.run pool threads.
+        self._group_cache_lock = threading.Lock()
+        # Ids of groups with moderation on, reloaded on the same TTL: most groups the bot sits
+        # in never enable it, and their messages should not reach SQLite at all.
+        self._group_cache_ttl = ttl
+        self._enabled_groups: Optional[frozenset] = None
+        self._enabled_groups_expires = 0.0
+        # One long-lived connection per thread (event loop + to_thread workers), so prepared
+        # statements stay cached instead of being re-parsed on every call.
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
 
     def _ensure_directory(self) -> None:
         directory = os.path.dirname(os.path.abspath(self.path))
@@ -280,20 +382,57 @@ class DB:
         if not self._initialized:
             self._init_db()
 
-        conn = sqlite3.connect(self.path, timeout=30)
-        conn.row_factory = sqlite3.Row
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._open_connection()
         try:
-            conn.execute("PRAGMA foreign_keys=ON;")
-            conn.execute("PRAGMA busy_timeout=30000;")
-
             yield conn
             conn.commit()
         except Exception as exc:
             conn.rollback()
             logger.error("Database error: %s", exc)
             raise
-        finally:
-            conn.close()
+
+    def _open_connection(self) -> sqlite3.Connection:
+        # check_same_thread=False only so close() can run from the shutdown thread;
+        # each connection is otherwise used by the thread that opened it.
+        conn = sqlite3.connect(
+            self.path,
+            timeout=30,
+            check_same_thread=False,
+            cached_statements=SQLITE_CACHED_STATEMENTS,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA foreign_keys=ON;")
+        conn.execute("PRAGMA busy_timeout=30000;")
+        self._local.conn = conn
+        with self._connections_lock:
+            self._connections.append(conn)
+        return conn
+
+    async def run(self, fn: Any, *args: Any, **kwargs: Any) -> Any:
+        """Await a blocking DB method on the pool threads instead of the event loop."""
+        if self._executor is None:
+            # Each worker keeps its own connection, so DB_POOL_SIZE also bounds the connection pool.
+            self._executor = ThreadPoolExecutor(
+                max_workers=max(1, settings.db_pool_size), thread_name_prefix="db"
+            )
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(fn, *args, **kwargs))
+
+    def close(self) -> None:
+        """Stop the pool threads and close every per-thread connection opened by this DB."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error as exc:
+                logger.warning("Failed to close database connection: %s", exc)
+        self._local = threading.local()
 
     def _ensure_user_conn(
         self,
@@ -436,6 +575,22 @@ class DB:
                 (1 if enabled else 0, user_id),
             )
 
+    def update_user_setting(self, user_id: int, field: str, value: Any) -> Dict[str, Any]:
+        """Set one settings column and return the updated user row."""
+        if field not in USER_SETTING_FIELDS:
+            raise ValueError("Invalid user setting field")
+        with self._conn() as conn:
+            self._ensure_user_conn(conn, user_id)
+            if _SQLITE_HAS_RETURNING:
+                row = conn.execute(
+                    f"UPDATE users SET {field} = ? WHERE user_id = ? RETURNING *",
+                    (value, user_id),
+                ).fetchone()
+            else:
+                conn.execute(f"UPDATE users SET {field} = ? WHERE user_id = ?", (value, user_id))
+                row = conn.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            return dict(row) if row else {}
+
     def ensure_group(self, group_id: int) -> None:
         """Ensure group exists"""
         with self._conn() as conn:
@@ -454,24 +609,153 @@ class DB:
 
     def get_group_settings(self, group_id: int) -> Dict[str, Any]:
         """Get group settings with defaults applied."""
-        defaults = {
-            "enabled": 0,
-            "language": "en",
-            "language_mode": "clean",
-            "warn_threshold": 2,
-            "mute_threshold": 3,
-            "welcome_enabled": 0,
-            "welcome_text": "",
-            "rules_enabled": 0,
-            "rules_text": "",
-            "security_enabled": 0,
-            "security_config_json": "{}",
-        }
-        group = self.get_group(group_id)
-        for key, value in defaults.items():
-            if group.get(key) is None:
-                group[key] = value
-        return group
+        return _apply_group_defaults(self.get_group(group_id))
+
+    def peek_group_for_moderation(self, group_id: int) -> Tuple[bool, Optional[GroupConfig]]:
+        """Cache-only load_group_for_moderation: (hit, config). Never touches SQLite.
+
+        Safe to call on the event loop; on a miss, await load_group_for_moderation via run().
+        """
+        if self._group_configs is None:
+            return False, None
+        now = time.monotonic()
+        with self._group_cache_lock:
+            if self._enabled_groups is None or now >= self._enabled_groups_expires:
+                return False, None
+            if group_id not in self._enabled_groups:
+                return True, None
+            config = self._group_configs.get(group_id, _MISSING)
+        if config is _MISSING:
+            return False, None
+        return True, config
+
+    def load_group_for_moderation(self, group_id: int) -> Optional[GroupConfig]:
+        """Get the settings moderation needs, or None if moderation is off for the group.
+
+        Results are cached for GROUP_CACHE_TTL seconds and dropped on group writes.
+        """
+        if self._group_configs is not None:
+            if group_id not in self._enabled_group_ids():
+                return None
+            with self._group_cache_lock:
+                config = self._group_configs.get(group_id, _MISSING)
+            if config is not _MISSING:
+                return config
+        with self._conn() as conn:
+            cursor = conn.execute(
+                """
+                SELECT enabled, language, language_mode, warn_threshold, mute_threshold,
+                    security_enabled,
+                    (
+                        SELECT MAX(COALESCE(end_ts, ?)) FROM group_subscriptions
+                        WHERE group_id = g.group_id AND status = 'active'
+                    ) AS subscription_expires
+                FROM groups g
+                WHERE group_id = ?
+                """,
+                (_NO_EXPIRY, group_id),
+            )
+            row = cursor.fetchone()
+        config = None
+        if row and row["enabled"]:
+            group = _apply_group_defaults(dict(row))
+            config = GroupConfig(
+                language=group["language"],
+                language_mode=group["language_mode"],
+                warn_threshold=int(group["warn_threshold"]),
+                mute_threshold=int(group["mute_threshold"]),
+                security_enabled=bool(group["security_enabled"]),
+                subscription_expires=group["subscription_expires"] or 0,
+            )
+        if self._group_configs is not None:
+            with self._group_cache_lock:
+                self._group_configs[group_id] = config
+        return config
+
+    def _enabled_group_ids(self) -> frozenset:
+        now = time.monotonic()
+        with self._group_cache_lock:
+            if self._enabled_groups is not None and now < self._enabled_groups_expires:
+                return self._enabled_groups
+        with self._conn() as conn:
+            cursor = conn.execute("SELECT group_id FROM groups WHERE enabled = 1")
+            enabled = frozenset(row["group_id"] for row in cursor.fetchall())
+        with self._group_cache_lock:
+            self._enabled_groups = enabled
+            self._enabled_groups_expires = now + self._group_cache_ttl
+        return enabled
+
+    def _invalidate_group(self, group_id: int) -> None:
+        with self._group_cache_lock:
+            if self._group_configs is not None:
+                self._group_configs.pop(group_id, None)
+            if self._group_bundles is not None:
+                self._group_bundles.pop(group_id, None)
+
+    def get_group_bundle(
+        self, group_id: int
+    ) -> Tuple[Dict[str, Any], Dict[str, Any], Dict[str, Any]]:
+        """Get group settings plus subscription and RAG add-on info in one query.
+
+        Results are cached for GROUP_CACHE_TTL seconds and dropped on group writes. Callers
+        get fresh copies they may modify.
+        """
+        bundle = None
+        if self._group_bundles is not None:
+            with self._group_cache_lock:
+                bundle = self._group_bundles.get(group_id)
+        if bundle is None:
+            bundle = self._load_group_bundle(group_id)
+            if self._group_bundles is not None:
+                with self._group_cache_lock:
+                    self._group_bundles[group_id] = bundle
+        group, subscription_info, rag_subscription_info = bundle
+        now = int(datetime.utcnow().timestamp())
+        return dict(group), _still_active(subscription_info, now), _still_active(rag_subscription_info, now)
+
+    def _load_group_bundle(
+        self, group_id: int
+    ) -> Tuple[Dict[str, Any], Dict[str, Any], Dict[str, Any]]:
+        now = int(datetime.utcnow().timestamp())
+        with self._conn() as conn:
+            self._ensure_group_conn(conn, group_id)
+            cursor = conn.execute(
+                """
+                SELECT g.*,
+                    s.status AS sub_status, s.end_ts AS sub_end_ts, s.plan_id AS sub_plan_id,
+                    r.status AS rag_status, r.end_ts AS rag_end_ts, r.plan_id AS rag_plan_id
+                FROM groups g
+                LEFT JOIN group_subscriptions s ON s.id = (
+                    SELECT id FROM group_subscriptions
+                    WHERE group_id = g.group_id
+                    ORDER BY start_ts DESC
+                    LIMIT 1
+                )
+                LEFT JOIN group_rag_subscriptions r ON r.id = (
+                    SELECT id FROM group_rag_subscriptions
+                    WHERE group_id = g.group_id
+                    ORDER BY start_ts DESC
+                    LIMIT 1
+                )
+                WHERE g.group_id = ?
+                """,
+                (group_id,),
+            )
+            row = cursor.fetchone()
+        group = dict(row) if row else {}
+        subscription_info = _subscription_info(
+            group.pop("sub_status", None),
+            group.pop("sub_end_ts", None),
+            group.pop("sub_plan_id", None),
+            now,
+        )
+        rag_subscription_info = _subscription_info(
+            group.pop("rag_status", None),
+            group.pop("rag_end_ts", None),
+            group.pop("rag_plan_id", None),
+            now,
+        )
+        return _apply_group_defaults(group), subscription_info, rag_subscription_info
 
     def set_group_enabled(self, group_id: int, enabled: bool) -> None:
         with self._conn() as conn:
@@ -480,6 +764,13 @@ class DB:
                 "UPDATE groups SET enabled = ? WHERE group_id = ?",
                 (1 if enabled else 0, group_id),
             )
+        self._invalidate_group(group_id)
+        with self._group_cache_lock:
+            if self._enabled_groups is not None:
+                if enabled:
+                    self._enabled_groups = self._enabled_groups | {group_id}
+                else:
+                    self._enabled_groups = self._enabled_groups - {group_id}
 
     def set_group_language(self, group_id: int, language: str) -> None:
         with self._conn() as conn:
@@ -488,6 +779,7 @@ class DB:
                 "UPDATE groups SET language = ? WHERE group_id = ?",
                 (language, group_id),
             )
+        self._invalidate_group(group_id)
 
     def set_group_language_mode(self, group_id: int, language_mode: str) -> None:
         with self._conn() as conn:
@@ -496,6 +788,7 @@ class DB:
                 "UPDATE groups SET language_mode = ? WHERE group_id = ?",
                 (language_mode, group_id),
             )
+        self._invalidate_group(group_id)
 
     def set_group_thresholds(self, group_id: int, warn_threshold: int, mute_threshold: int) -> None:
         with self._conn() as conn:
@@ -504,6 +797,7 @@ class DB:
                 "UPDATE groups SET warn_threshold = ?, mute_threshold = ? WHERE group_id = ?",
                 (warn_threshold, mute_threshold, group_id),
             )
+        self._invalidate_group(group_id)
 
     def set_group_toggle(self, group_id: int, field: str, enabled: bool) -> None:
         if field not in {"welcome_enabled", "rules_enabled", "security_enabled"}:
@@ -514,6 +808,7 @@ class DB:
                 f"UPDATE groups SET {field} = ? WHERE group_id = ?",
                 (1 if enabled else 0, group_id),
             )
+        self._invalidate_group(group_id)
 
     def set_group_welcome_text(self, group_id: int, welcome_text: str) -> None:
         with self._conn() as conn:
@@ -522,6 +817,7 @@ class DB:
                 "UPDATE groups SET welcome_text = ? WHERE group_id = ?",
                 (welcome_text, group_id),
             )
+        self._invalidate_group(group_id)
 
     def set_group_rules_text(self, group_id: int, rules_text: str) -> None:
         with self._conn() as conn:
@@ -530,6 +826,7 @@ class DB:
                 "UPDATE groups SET rules_text = ? WHERE group_id = ?",
                 (rules_text, group_id),
             )
+        self._invalidate_group(group_id)
 
     def set_group_security_config(self, group_id: int, config_json: str) -> None:
         with self._conn() as conn:
@@ -538,22 +835,24 @@ class DB:
                 "UPDATE groups SET security_config_json = ? WHERE group_id = ?",
                 (config_json, group_id),
             )
+        self._invalidate_group(group_id)
 
     def increment_violations(self, group_id: int, user_id: int, ts: int) -> int:
+        upsert = """
+            INSERT INTO group_user_state (group_id, user_id, violations, last_ts)
+            VALUES (?, ?, 1, ?)
+            ON CONFLICT(group_id, user_id)
+            DO UPDATE SET violations = violations + 1, last_ts = excluded.last_ts
+        """
         with self._conn() as conn:
-            conn.execute(
-                """
-                INSERT INTO group_user_state (group_id, user_id, violations, last_ts)
-                VALUES (?, ?, 1, ?)
-                ON CONFLICT(group_id, user_id)
-                DO UPDATE SET violations = violations + 1, last_ts = excluded.last_ts
-                """,
-                (group_id, user_id, ts),
-            )
-            cursor = conn.execute(
-                "SELECT violations FROM group_user_state WHERE group_id = ? AND user_id = ?",
-                (group_id, user_id),
-            )
+            if _SQLITE_HAS_RETURNING:
+                cursor = conn.execute(upsert + " RETURNING violations", (group_id, user_id, ts))
+            else:
+                conn.execute(upsert, (group_id, user_id, ts))
+                cursor = conn.execute(
+                    "SELECT violations FROM group_user_state WHERE group_id = ? AND user_id = ?",
+                    (group_id, user_id),
+                )
             row = cursor.fetchone()
             return int(row["violations"]) if row else 0
 
@@ -572,7 +871,18 @@ class DB:
                 INSERT INTO moderation_log (ts, group_id, user_id, trigger, decision_summary, action, meta_json)
                 VALUES (?, ?, ?, ?, ?, ?, ?)
                 """,
-                (int(datetime.utcnow().timestamp()), group_id, user_id, trigger, decision_summary, action, meta_json),
+                (int(time.time()), group_id, user_id, trigger, decision_summary, action, meta_json),
+            )
+
+    def record_moderation_logs(self, rows: List[Tuple[Any, ...]]) -> None:
+        """Insert (ts, group_id, user_id, trigger, decision_summary, action, meta_json) rows."""
+        with self._conn() as conn:
+            conn.executemany(
+                """
+                INSERT INTO moderation_log (ts, group_id, user_id, trigger, decision_summary, action, meta_json)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                rows,
             )
 
     def get_group_logs(self, group_id: int, limit: int = 20) -> List[Dict[str, Any]]:
@@ -598,17 +908,13 @@ class DB:
         metadata: Optional[Dict[str, Any]] = None,
     ) -> str:
         event_id = str(uuid.uuid4())
-        meta_json = json.dumps(metadata or {}, ensure_ascii=False)
+        meta_json = jsonutil.dumps(metadata or {})
         with self._conn() as conn:
             conn.execute(
-                """
-                INSERT INTO audit_events
-                (event_id, ts, chat_id, actor_user_id, target_user_id, action, reason, metadata_json)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """,
+                _AUDIT_EVENT_INSERT,
                 (
                     event_id,
-                    int(datetime.utcnow().timestamp()),
+                    int(time.time()),
                     chat_id,
                     actor_user_id,
                     target_user_id,
@@ -619,6 +925,11 @@ class DB:
             )
         return event_id
 
+    def record_audit_events(self, rows: List[Tuple[Any, ...]]) -> None:
+        """Insert (event_id, ts, chat_id, actor_user_id, target_user_id, action, reason, metadata_json) rows."""
+        with self._conn() as conn:
+            conn.executemany(_AUDIT_EVENT_INSERT, rows)
+
     def get_audit_event(self, chat_id: int, event_id: str) -> Optional[Dict[str, Any]]:
         with self._conn() as conn:
             cursor = conn.execute(
@@ -705,8 +1016,8 @@ class DB:
             results = {}
             for row in cursor.fetchall():
                 try:
-                    results[row["event_id"]] = json.loads(row["embedding_json"])
-                except json.JSONDecodeError:
+                    results[row["event_id"]] = jsonutil.loads(row["embedding_json"])
+                except jsonutil.JSONDecodeError:
                     continue
             return results
 
@@ -717,7 +1028,7 @@ class DB:
                 INSERT OR IGNORE INTO audit_embeddings (event_id, embedding_json, created_at)
                 VALUES (?, ?, ?)
                 """,
-                (event_id, json.dumps(embedding), int(time.time())),
+                (event_id, jsonutil.dumps(embedding), int(time.time())),
             )
 
     def add_group_subscription(
@@ -738,7 +1049,10 @@ class DB:
                 """,
                 (group_id, plan_id, stars_amount, transaction_id, start_ts, end_ts),
             )
-            return cursor.rowcount == 1
+            added = cursor.rowcount == 1
+        if added:
+            self._invalidate_group(group_id)
+        return added
 
     def create_invoice(
         self,
@@ -768,6 +1082,54 @@ class DB:
             row = cursor.fetchone()
             return dict(row) if row else None
 
+    def validate_invoice(
+        self,
+        invoice_id: str,
+        user_id: int,
+        currency: str,
+        amount: int,
+        ttl_seconds: int,
+    ) -> Optional[Dict[str, Any]]:
+        """Return the invoice if it is still payable by this user for this amount, else None."""
+        now = int(time.time())
+        with self._conn() as conn:
+            row = conn.execute(
+                """
+                SELECT * FROM invoices
+                WHERE invoice_id = ?
+                AND status = 'created'
+                AND user_id = ?
+                AND currency = ?
+                AND amount = ?
+                AND ? - created_at <= ?
+                """,
+                (invoice_id, user_id, currency, amount, now, ttl_seconds),
+            ).fetchone()
+            return dict(row) if row else None
+
+    def prepare_invoice_target(
+        self,
+        user_id: int,
+        group_id: Optional[int] = None,
+        require_group_subscription: bool = False,
+    ) -> bool:
+        """Ensure the row a validated invoice pays for, in one transaction.
+
+        Group-scoped plans ensure the group (and with require_group_subscription, check it has
+        an active subscription first, returning False without touching it); personal plans
+        ensure the user.
+        """
+        with self._conn() as conn:
+            if group_id is None:
+                self._ensure_user_conn(conn, user_id)
+                return True
+            if require_group_subscription and not self._group_subscription_active_conn(
+                conn, group_id, int(time.time())
+            ):
+                return False
+            self._ensure_group_conn(conn, group_id)
+            return True
+
     def process_invoice_payment(
         self,
         invoice_id: str,
@@ -775,32 +1137,25 @@ class DB:
         user_id: int,
         stars_amount: int,
         resolves_added: int,
-    ) -> str:
+    ) -> Tuple[str, Optional[int]]:
+        """Settle a personal invoice in one transaction.
+
+        Returns (status, resolves_remaining); the balance is only set when status is "processed".
+        """
         with self._conn() as conn:
             if not telegram_charge_id:
                 logger.warning("Missing Telegram charge id for invoice %s", invoice_id)
-                return "invalid"
+                return "invalid", None
 
             cursor = conn.execute(
-                "SELECT 1 FROM invoices WHERE telegram_charge_id = ?",
-                (telegram_charge_id,),
-            )
-            if cursor.fetchone():
-                return "duplicate"
-
-            cursor = conn.execute(
-                "SELECT 1 FROM purchases WHERE transaction_id = ?",
-                (telegram_charge_id,),
+                """
+                SELECT EXISTS (SELECT 1 FROM invoices WHERE telegram_charge_id = ?)
+                    OR EXISTS (SELECT 1 FROM purchases WHERE transaction_id = ?)
+                """,
+                (telegram_charge_id, telegram_charge_id),
             )
-            if cursor.fetchone():
-                return "duplicate"
-
-            row = conn.execute(
-                "SELECT status FROM invoices WHERE invoice_id = ?",
-                (invoice_id,),
-            ).fetchone()
-            if not row or row["status"] != "created":
-                return "invalid"
+            if cursor.fetchone()[0]:
+                return "duplicate", None
 
             cursor = conn.execute(
                 """
@@ -811,7 +1166,7 @@ class DB:
                 (telegram_charge_id, invoice_id),
             )
             if cursor.rowcount != 1:
-                return "invalid"
+                return "invalid", None
 
             self._ensure_user_conn(conn, user_id)
             cursor = conn.execute(
@@ -823,13 +1178,24 @@ class DB:
                 (user_id, stars_amount, resolves_added, telegram_charge_id),
             )
             if cursor.rowcount == 0:
-                return "duplicate"
-
-            conn.execute(
-                "UPDATE users SET resolves_remaining = resolves_remaining + ? WHERE user_id = ?",
-                (resolves_added, user_id),
-            )
-            return "processed"
+                return "duplicate", None
+
+            if _SQLITE_HAS_RETURNING:
+                row = conn.execute(
+                    "UPDATE users SET resolves_remaining = resolves_remaining + ? WHERE user_id = ? "
+                    "RETURNING resolves_remaining",
+                    (resolves_added, user_id),
+                ).fetchone()
+            else:
+                conn.execute(
+                    "UPDATE users SET resolves_remaining = resolves_remaining + ? WHERE user_id = ?",
+                    (resolves_added, user_id),
+                )
+                row = conn.execute(
+                    "SELECT resolves_remaining FROM users WHERE user_id = ?",
+                    (user_id,),
+                ).fetchone()
+            return "processed", int(row["resolves_remaining"]) if row else None
 
     def process_group_invoice_payment(
         self,
@@ -847,26 +1213,15 @@ class DB:
                 return "invalid"
 
             cursor = conn.execute(
-                "SELECT 1 FROM invoices WHERE telegram_charge_id = ?",
-                (telegram_charge_id,),
-            )
-            if cursor.fetchone():
-                return "duplicate"
-
-            cursor = conn.execute(
-                "SELECT 1 FROM group_subscriptions WHERE transaction_id = ?",
-                (telegram_charge_id,),
+                """
+                SELECT EXISTS (SELECT 1 FROM invoices WHERE telegram_charge_id = ?)
+                    OR EXISTS (SELECT 1 FROM group_subscriptions WHERE transaction_id = ?)
+                """,
+                (telegram_charge_id, telegram_charge_id),
             )
-            if cursor.fetchone():
+            if cursor.fetchone()[0]:
                 return "duplicate"
 
-            row = conn.execute(
-                "SELECT status FROM invoices WHERE invoice_id = ?",
-                (invoice_id,),
-            ).fetchone()
-            if not row or row["status"] != "created":
-                return "invalid"
-
             cursor = conn.execute(
                 """
                 UPDATE invoices
@@ -889,7 +1244,8 @@ class DB:
             if cursor.rowcount == 0:
                 return "duplicate"
 
-            return "processed"
+        self._invalidate_group(group_id)
+        return "processed"
 
     def process_rag_invoice_payment(
         self,
@@ -907,26 +1263,15 @@ class DB:
                 return "invalid"
 
             cursor = conn.execute(
-                "SELECT 1 FROM invoices WHERE telegram_charge_id = ?",
-                (telegram_charge_id,),
-            )
-            if cursor.fetchone():
-                return "duplicate"
-
-            cursor = conn.execute(
-                "SELECT 1 FROM group_rag_subscriptions WHERE transaction_id = ?",
-                (telegram_charge_id,),
+                """
+                SELECT EXISTS (SELECT 1 FROM invoices WHERE telegram_charge_id = ?)
+                    OR EXISTS (SELECT 1 FROM group_rag_subscriptions WHERE transaction_id = ?)
+                """,
+                (telegram_charge_id, telegram_charge_id),
             )
-            if cursor.fetchone():
+            if cursor.fetchone()[0]:
                 return "duplicate"
 
-            row = conn.execute(
-                "SELECT status FROM invoices WHERE invoice_id = ?",
-                (invoice_id,),
-            ).fetchone()
-            if not row or row["status"] != "created":
-                return "invalid"
-
             cursor = conn.execute(
                 """
                 UPDATE invoices
@@ -949,23 +1294,27 @@ class DB:
             if cursor.rowcount == 0:
                 return "duplicate"
 
-            return "processed"
+        self._invalidate_group(group_id)
+        return "processed"
+
+    def _group_subscription_active_conn(self, conn: sqlite3.Connection, group_id: int, now: int) -> bool:
+        cursor = conn.execute(
+            """
+            SELECT 1 FROM group_subscriptions
+            WHERE group_id = ?
+            AND status = 'active'
+            AND (end_ts IS NULL OR end_ts > ?)
+            ORDER BY start_ts DESC
+            LIMIT 1
+            """,
+            (group_id, now),
+        )
+        return cursor.fetchone() is not None
 
     def group_subscription_active(self, group_id: int) -> bool:
         now = int(datetime.utcnow().timestamp())
         with self._conn() as conn:
-            cursor = conn.execute(
-                """
-                SELECT 1 FROM group_subscriptions
-                WHERE group_id = ?
-                AND status = 'active'
-                AND (end_ts IS NULL OR end_ts > ?)
-                ORDER BY start_ts DESC
-                LIMIT 1
-                """,
-                (group_id, now),
-            )
-            return cursor.fetchone() is not None
+            return self._group_subscription_active_conn(conn, group_id, now)
 
     def group_rag_subscription_active(self, group_id: int) -> bool:
         now = int(datetime.utcnow().timestamp())
@@ -988,7 +1337,7 @@ class DB:
         with self._conn() as conn:
             cursor = conn.execute(
                 """
-                SELECT * FROM group_subscriptions
+                SELECT status, end_ts, plan_id FROM group_subscriptions
                 WHERE group_id = ?
                 ORDER BY start_ts DESC
                 LIMIT 1
@@ -997,23 +1346,15 @@ class DB:
             )
             row = cursor.fetchone()
             if not row:
-                return {"active": False, "end_ts": None, "plan_id": None}
-            data = dict(row)
-            active = data.get("status") == "active" and (
-                data.get("end_ts") is None or data.get("end_ts") > now
-            )
-            return {
-                "active": active,
-                "end_ts": data.get("end_ts"),
-                "plan_id": data.get("plan_id"),
-            }
+                return _subscription_info(None, None, None, now)
+            return _subscription_info(row["status"], row["end_ts"], row["plan_id"], now)
 
     def get_group_rag_subscription_info(self, group_id: int) -> Dict[str, Any]:
         now = int(datetime.utcnow().timestamp())
         with self._conn() as conn:
             cursor = conn.execute(
                 """
-                SELECT * FROM group_rag_subscriptions
+                SELECT status, end_ts, plan_id FROM group_rag_subscriptions
                 WHERE group_id = ?
                 ORDER BY start_ts DESC
                 LIMIT 1
@@ -1022,16 +1363,8 @@ class DB:
             )
             row = cursor.fetchone()
             if not row:
-                return {"active": False, "end_ts": None, "plan_id": None}
-            data = dict(row)
-            active = data.get("status") == "active" and (
-                data.get("end_ts") is None or data.get("end_ts") > now
-            )
-            return {
-                "active": active,
-                "end_ts": data.get("end_ts"),
-                "plan_id": data.get("plan_id"),
-            }
+                return _subscription_info(None, None, None, now)
+            return _subscription_info(row["status"], row["end_ts"], row["plan_id"], now)
 
     def add_feedback(self, user_id: int, text: str, meta_json: str) -> None:
         """Record user feedback"""
@@ -1058,6 +1391,29 @@ class DB:
                 }
             return {"last_resolve_was_paid": False, "free_retry_available": False}
 
+    def get_user_with_retry_flags(self, user_id: int) -> Dict[str, Any]:
+        """Get user data merged with retry flags in one query"""
+        with self._conn() as conn:
+            self._ensure_user_conn(conn, user_id)
+            cursor = conn.execute(
+                """
+                SELECT u.*,
+                    COALESCE(r.last_resolve_was_paid, 0) AS last_resolve_was_paid,
+                    COALESCE(r.free_retry_available, 0) AS free_retry_available
+                FROM users u
+                LEFT JOIN retry_flags r ON r.user_id = u.user_id
+                WHERE u.user_id = ?
+                """,
+                (user_id,),
+            )
+            row = cursor.fetchone()
+            if not row:
+                return {}
+            user = dict(row)
+            user["last_resolve_was_paid"] = bool(user["last_resolve_was_paid"])
+            user["free_retry_available"] = bool(user["free_retry_available"])
+            return user
+
     def set_retry_flags(self, user_id: int, last_paid: bool, free_retry: bool) -> None:
         """Update retry flags"""
         with self._conn() as conn:
@@ -1107,6 +1463,24 @@ class DB:
             )
             return cursor.rowcount == 1
 
+    def consume_paid_retry(self, user_id: int) -> bool:
+        """Consume one paid resolve for a retry and clear the free retry in one transaction."""
+        with self._conn() as conn:
+            self._ensure_user_conn(conn, user_id)
+
+            cursor = conn.execute(
+                "UPDATE users SET resolves_remaining = resolves_remaining - 1 "
+                "WHERE user_id = ? AND resolves_remaining > 0",
+                (user_id,),
+            )
+            if cursor.rowcount != 1:
+                return False
+            conn.execute(
+                "UPDATE retry_flags SET last_resolve_was_paid = 1, free_retry_available = 0 WHERE user_id = ?",
+                (user_id,),
+            )
+            return True
+
     def can_use_free_today(self, user_id: int) -> bool:
         """Check if free resolve is available today"""
         today = date.today().isoformat()
@@ -1147,7 +1521,20 @@ class DB:
                 """INSERT INTO interactions
                 (user_id, goal, input_text, output_options, used_paid)
                 VALUES (?, ?, ?, ?, ?)""",
-                (user_id, goal, input_text[:1000], json.dumps(output_options), 1 if used_paid else 0),
+                (user_id, goal, input_text[:1000], jsonutil.dumps(output_options), 1 if used_paid else 0),
+            )
+
+    def log_interactions(self, rows: List[Tuple[int, str, str, List[str], bool]]) -> None:
+        """Log (user_id, goal, input_text, output_options, used_paid) interactions in one batch"""
+        with self._conn() as conn:
+            conn.executemany(
+                """INSERT INTO interactions
+                (user_id, goal, input_text, output_options, used_paid)
+                VALUES (?, ?, ?, ?, ?)""",
+                [
+                    (user_id, goal, input_text[:1000], jsonutil.dumps(output_options), 1 if used_paid else 0)
+                    for user_id, goal, input_text, output_options, used_paid in rows
+                ],
             )
 
     def get_user_stats(self, user_id: int) -> Dict[str, Any]:
@@ -1172,27 +1559,36 @@ class DB:
                 (user_id,),
             )
             row = cursor.fetchone()
-            age_days = 0
-            if row and row["created_at"]:
-                try:
-                    created = datetime.strptime(str(row["created_at"]), "%Y-%m-%d %H:%M:%S")
-                    age_days = (datetime.utcnow() - created).days
-                except ValueError:
-                    try:
-                        created = datetime.fromisoformat(str(row["created_at"]).replace("Z", "+00:00"))
-                        age_days = (datetime.utcnow() - created).days
-                    except ValueError:
-                        logger.warning(
-                            "Could not parse created_at for user %s", user_id
-                        )
 
             return {
                 "total_interactions": total,
                 "paid_interactions": paid,
                 "free_interactions": total - paid,
-                "account_age_days": max(0, age_days),
+                "account_age_days": _account_age_days(row["created_at"] if row else None, user_id),
             }
 
+    def get_account_bundle(self, user_id: int) -> Dict[str, Any]:
+        """Get everything /account shows (balance, free status, usage, age) in one query."""
+        today = date.today().isoformat()
+        with self._conn() as conn:
+            self._ensure_user_conn(conn, user_id)
+            row = conn.execute(
+                """
+                SELECT u.resolves_remaining, u.free_used_date, u.created_at,
+                    (SELECT COUNT(*) FROM interactions i WHERE i.user_id = u.user_id)
+                        AS total_interactions
+                FROM users u
+                WHERE u.user_id = ?
+                """,
+                (user_id,),
+            ).fetchone()
+        return {
+            "resolves_remaining": row["resolves_remaining"] or 0,
+            "free_available": row["free_used_date"] != today,
+            "total_interactions": row["total_interactions"],
+            "account_age_days": _account_age_days(row["created_at"], user_id),
+        }
+
     def health_check(self) -> bool:
         """Check if database is accessible and tables exist"""
         try:
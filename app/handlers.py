@@ -1,18 +1,26 @@
-import json
+import asyncio
 import logging
-import re
 import time
-import traceback
-from datetime import datetime, timedelta
-from collections import defaultdict, deque
-from typing import Optional
+from array import array
+from functools import cached_property, lru_cache, partial
+from typing import NamedTuple, Optional
 from aiogram import Router, F, Bot
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
-from aiogram.types import Message, CallbackQuery, LabeledPrice, PreCheckoutQuery, ChatPermissions
+from aiogram.types import (
+    CallbackQuery,
+    ChatMemberUpdated,
+    ChatPermissions,
+    InlineKeyboardButton,
+    LabeledPrice,
+    Message,
+    PreCheckoutQuery,
+)
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from cachetools import LRUCache, TTLCache
 
+from . import jsonutil
 from .config import settings
 from .db import DB
 from .languages import (
@@ -58,10 +66,18 @@ from .rag import (
     RAG_WINDOWS,
     RAG_ACTION_FILTERS,
 )
+from .triggers import detect_trigger
+from .writer import LogWriter
 
 logger = logging.getLogger(__name__)
 router = Router()
 
+# Settings are loaded once at startup and never change afterwards, so the feature flags
+# read on every message are bound once here; changing them takes a restart.
+_USE_LLM = settings.use_llm
+_FEATURE_V2_PERSONAL = settings.feature_v2_personal
+_FEATURE_V2_GROUPS = settings.feature_v2_groups
+
 STYLE_OPTIONS = {
     "neutral": "🙂 Neutral",
     "softer": "🫧 Softer",
@@ -70,16 +86,47 @@ STYLE_OPTIONS = {
 }
 
 LANGUAGE_MODES = ["clean", "adult", "unrestricted"]
-
-INSULT_WORDS = {"idiot", "moron", "stupid", "dumb", "loser"}
-PROFANITY_WORDS = {"fuck", "shit", "bitch", "asshole", "bastard"}
-SLUR_WORDS = {"fag", "kike", "chink", "nigger", "tranny"}
-SELF_HARM_TAUNTS = {"kys", "kill yourself", "end yourself", "go die"}
+_LANGUAGE_MODE_SET = frozenset(LANGUAGE_MODES)
+_SUPPORTED_LANGUAGE_SET = frozenset(SUPPORTED_LANGUAGES)
+_SECURITY_TOGGLES = frozenset({"anti_link", "anti_spam"})
+_SECURITY_FIELDS = frozenset({"mute_seconds", "max_warnings"})
+# settings:* callbacks rejected outright while FEATURE_V2_PERSONAL is off.
+_V2_PERSONAL_SETTINGS = frozenset({"v2", "lang", "mode"})
+_V2_PERSONAL_MENUS = frozenset({"language", "mode"})
+_SETTINGS_READ_USER = frozenset({"menu", "goal", "style", "lang", "mode"})
 
 FLOOD_LIMIT = 5
 FLOOD_WINDOW_SECONDS = 10
-_flood_tracker = defaultdict(lambda: deque(maxlen=FLOOD_LIMIT * 2))
-_group_entitlement_notice_ts: dict[int, int] = {}
+# Per-(group, user) timestamp rings packed into one int64 array: each row is
+# [head, ts_0 .. ts_{N-1}] and _flood_slots maps the key to its row. The ring
+# holds the last FLOOD_LIMIT timestamps; ring[head] is always the oldest.
+_FLOOD_RING_SIZE = FLOOD_LIMIT
+_FLOOD_STRIDE = _FLOOD_RING_SIZE + 1
+_FLOOD_EMPTY = -(1 << 62)
+_flood_slots: dict[tuple[int, int], int] = {}
+_FLOOD_EMPTY_ROW = array("q", [0] + [_FLOOD_EMPTY] * _FLOOD_RING_SIZE)
+_flood_rings = array("q")
+GROUP_ENTITLEMENT_NOTICE_SECONDS = 3600
+# Groups notified about a missing subscription; entries expire after the cooldown.
+_group_entitlement_notice_ts = TTLCache(maxsize=100_000, ttl=GROUP_ENTITLEMENT_NOTICE_SECONDS)
+ADMIN_STATUS_TTL_SECONDS = 60
+_admin_status_cache = TTLCache(maxsize=10000, ttl=ADMIN_STATUS_TTL_SECONDS)
+_admin_status_pending: dict[tuple[int, int], asyncio.Future] = {}
+BOT_RESTRICT_TTL_SECONDS = 300
+# Whether the bot may restrict members, per group; dropped when the bot's own membership changes.
+_bot_restrict_cache = TTLCache(maxsize=4096, ttl=BOT_RESTRICT_TTL_SECONDS)
+# Last admin panel state rendered into each (chat_id, message_id), to skip no-op edits.
+_groupadmin_panel_state = TTLCache(maxsize=2048, ttl=3600)
+CALLBACK_DEDUPE_SECONDS = 0.4
+# (user_id, callback data) pairs seen inside the window; a repeat is a double tap.
+_recent_callbacks = TTLCache(maxsize=10_000, ttl=CALLBACK_DEDUPE_SECONDS)
+GROUP_LLM_CONCURRENCY = 16
+_group_llm_semaphore: Optional[asyncio.Semaphore] = None
+_group_deescalation_cache = LRUCache(maxsize=1024)
+_group_deescalation_pending: dict[tuple[str, str, str], asyncio.Future] = {}
+
+MUTE_SECONDS = 600
+_MUTE_PERMISSIONS = ChatPermissions(can_send_messages=False)
 
 GROUP_TEMPLATES = {
     "deescalate": "Let’s keep this respectful and calm so everyone feels safe to talk.",
@@ -89,6 +136,16 @@ GROUP_TEMPLATES = {
     "permission": "⚠️ I need permission to mute members. Admins, please enable the restriction permission.",
     "notify_admins": "Admins notified: moderation action taken.",
 }
+_TPL_DEESCALATE = GROUP_TEMPLATES["deescalate"]
+_TPL_DEESCALATE_FLOOD = GROUP_TEMPLATES["deescalate_flood"]
+_TPL_WARN = GROUP_TEMPLATES["warn"]
+_TPL_MUTE = GROUP_TEMPLATES["mute"]
+_TPL_PERMISSION = GROUP_TEMPLATES["permission"]
+_TPL_NOTIFY_ADMINS = GROUP_TEMPLATES["notify_admins"]
+_ADMIN_ONLY_TEXT = "This command is restricted to group admins."
+_INVOICE_FAILED_TEXT = "Failed to create invoice. Please try again."
+_PRICING_MISCONFIGURED_TEXT = "Pricing misconfigured. Please contact admin."
+_NO_CHANGE_TEXT = "No change."
 
 WELCOME_MAX_LENGTH = 2000
 RULES_MAX_LENGTH = 4000
@@ -135,12 +192,80 @@ def _should_allow_xtr_amount(plan_id: str, plan_stars: int, amount: int, currenc
     return True
 
 
+# send_invoice arguments that never change per click, built once per plan.
+_INVOICE_COMMON = {
+    "provider_token": "",
+    "currency": "XTR",
+    "need_email": False,
+    "need_name": False,
+    "need_phone_number": False,
+    "need_shipping_address": False,
+    "is_flexible": False,
+    "disable_notification": True,
+    "protect_content": False,
+}
+
+
+def _personal_invoice_kwargs(plan) -> dict:
+    return {
+        **_INVOICE_COMMON,
+        "title": f"Personal {plan.name} - The Resolver",
+        "description": f"Personal (DM) plan: {plan.resolves} resolve(s).",
+        "prices": [LabeledPrice(label=f"{plan.resolves} Resolves (Personal)", amount=plan.stars)],
+        "start_parameter": "resolver_bot",
+    }
+
+
+def _group_invoice_kwargs(plan) -> dict:
+    duration_label = (
+        "one-time, non-refundable, lifetime access"
+        if plan.duration_days is None
+        else f"{plan.duration_days} days"
+    )
+    return {
+        **_INVOICE_COMMON,
+        "title": f"Group {plan.name} Plan",
+        "description": (
+            "Per-group subscription. "
+            f"Duration: {duration_label}. "
+            "Activates paid group moderation."
+        ),
+        "prices": [LabeledPrice(label=f"Group {plan.name} ({duration_label})", amount=plan.stars)],
+        "start_parameter": "resolver_group_sub",
+    }
+
+
+def _rag_invoice_kwargs(plan) -> dict:
+    duration_label = f"{plan.duration_days} days" if plan.duration_days is not None else "lifetime"
+    return {
+        **_INVOICE_COMMON,
+        "title": plan.name,
+        "description": (
+            "Per-group add-on. "
+            f"Duration: {duration_label}. "
+            "Requires an active group subscription."
+        ),
+        "prices": [LabeledPrice(label=f"{plan.name} ({duration_label})", amount=plan.stars)],
+        "start_parameter": "resolver_group_rag",
+    }
+
+
+_PERSONAL_INVOICES = {plan_id: _personal_invoice_kwargs(plan) for plan_id, plan in PERSONAL_PLANS.items()}
+_GROUP_INVOICES = {plan_id: _group_invoice_kwargs(plan) for plan_id, plan in GROUP_PLANS.items()}
+_RAG_INVOICES = {plan_id: _rag_invoice_kwargs(plan) for plan_id, plan in RAG_ADDON_PLANS.items()}
+
+
 def _amount_from_total(total_amount: int, currency: str) -> int:
     if currency == "XTR":
         return total_amount
     return total_amount // 100
 
 
+INVOICE_REJECT_MESSAGE = "Invoice expired or invalid. Please try again."
+PAYMENT_VERIFICATION_FAILED = "Payment verification failed. Please contact support."
+PAYMENT_PROCESSING_ERROR = "Payment processing error. Please contact support."
+
+
 async def _pre_checkout_fail(pre_checkout_query: PreCheckoutQuery, reason: str) -> None:
     logger.info(
         "Pre-checkout validation: ok=%s payload=%s reason=%s",
@@ -151,41 +276,102 @@ async def _pre_checkout_fail(pre_checkout_query: PreCheckoutQuery, reason: str)
     await pre_checkout_query.answer(ok=False, error_message=reason)
 
 
+async def _pre_checkout_reject_reason(db: DB, invoice: Optional[dict]) -> Optional[str]:
+    """Why an invoice from DB.validate_invoice cannot be paid, or None if it can.
+
+    User, currency, amount, status and TTL are already checked in validate_invoice's query.
+    The target group or user row is only ensured once the plan itself checks out.
+    """
+    if not invoice:
+        return INVOICE_REJECT_MESSAGE
+    plan_key = str(invoice["plan_id"])
+    group_info = parse_group_plan_key(plan_key)
+    rag_info = None if group_info else parse_rag_plan_key(plan_key)
+    if group_info:
+        plan = GROUP_PLANS.get(group_info["plan_id"])
+    elif rag_info:
+        plan = RAG_ADDON_PLANS.get(rag_info["plan_id"])
+    else:
+        plan = PERSONAL_PLANS.get(parse_personal_plan_key(plan_key) or plan_key)
+    if not plan or plan.stars != int(invoice["amount"]):
+        return INVOICE_REJECT_MESSAGE
+    scope = group_info or rag_info
+    prepared = await db.run(
+        db.prepare_invoice_target,
+        int(invoice["user_id"]),
+        group_id=int(scope["group_id"]) if scope else None,
+        require_group_subscription=rag_info is not None,
+    )
+    if not prepared:
+        return "Group subscription required for RAG."
+    return None
+
+
+# Strong references to fire-and-forget tasks so they are not garbage-collected mid-flight.
+_background_tasks: set = set()
+
+
+def _spawn(coro) -> asyncio.Task:
+    """Run a side effect (callback answer, audit write) off the response path."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_task_done)
+    return task
+
+
+def _is_repeat_callback(cb: CallbackQuery) -> bool:
+    key = (cb.from_user.id, cb.data)
+    if key in _recent_callbacks:
+        return True
+    _recent_callbacks[key] = True
+    return False
+
+
+def _background_task_done(task: asyncio.Task) -> None:
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Background task failed", exc_info=task.exception())
+
+
+# Telegram's (lowercase) error text for an edit that changes nothing.
+_NOT_MODIFIED = "message is not modified"
+
+
 async def _edit_or_send(message: Message, text: str, reply_markup=None) -> None:
     try:
         await message.edit_text(text, reply_markup=reply_markup)
     except TelegramBadRequest as exc:
-        if "message is not modified" in str(exc).lower():
+        if _NOT_MODIFIED in (exc.message or ""):
             return
         try:
             await message.answer(text, reply_markup=reply_markup)
         except Exception:
-            logger.error("Failed to send fallback message:\n%s", traceback.format_exc())
+            logger.exception("Failed to send fallback message")
     except Exception:
-        logger.error("Failed to edit message:\n%s", traceback.format_exc())
+        logger.exception("Failed to edit message")
         try:
             await message.answer(text, reply_markup=reply_markup)
         except Exception:
-            logger.error("Failed to send fallback message:\n%s", traceback.format_exc())
+            logger.exception("Failed to send fallback message")
 
 
 async def _edit_message(message: Message, text: str, reply_markup=None) -> None:
     try:
         await message.edit_text(text, reply_markup=reply_markup)
     except TelegramBadRequest as exc:
-        if "message is not modified" in str(exc).lower():
+        if _NOT_MODIFIED in (exc.message or ""):
             return
         logger.warning("Failed to edit message: %s", exc)
         try:
             await message.answer(text, reply_markup=reply_markup)
         except Exception:
-            logger.error("Failed to send fallback message:\n%s", traceback.format_exc())
+            logger.exception("Failed to send fallback message")
     except Exception:
-        logger.error("Failed to edit message:\n%s", traceback.format_exc())
+        logger.exception("Failed to edit message")
         try:
             await message.answer(text, reply_markup=reply_markup)
         except Exception:
-            logger.error("Failed to send fallback message:\n%s", traceback.format_exc())
+            logger.exception("Failed to send fallback message")
 
 
 def _fallback_notice() -> str:
@@ -197,69 +383,120 @@ def _fallback_notice() -> str:
 
 
 def _maybe_add_fallback(text: str) -> str:
-    return text + _fallback_notice() if not settings.use_llm else text
+    return text + _fallback_notice() if not _USE_LLM else text
 
 
-async def is_group_admin(bot: Bot, chat_id: int, user_id: int) -> bool:
+async def _fetch_admin_status(bot: Bot, chat_id: int, user_id: int) -> Optional[bool]:
     try:
         member = await bot.get_chat_member(chat_id, user_id)
         return member.status in {"administrator", "creator"}
     except Exception:
-        return False
+        return None
+
+
+async def is_group_admin(bot: Bot, chat_id: int, user_id: int) -> bool:
+    key = (chat_id, user_id)
+    cached = _admin_status_cache.get(key)
+    if cached is not None:
+        return cached
+    # Concurrent misses for the same member share one get_chat_member call.
+    pending = _admin_status_pending.get(key)
+    if pending is not None:
+        return await asyncio.shield(pending)
+
+    pending = asyncio.get_running_loop().create_future()
+    _admin_status_pending[key] = pending
+    try:
+        status = await _fetch_admin_status(bot, chat_id, user_id)
+    except BaseException:
+        pending.cancel()
+        raise
+    finally:
+        del _admin_status_pending[key]
+    # Lookup failures are not cached so a transient API error doesn't lock admins out.
+    if status is not None:
+        _admin_status_cache[key] = status
+    pending.set_result(bool(status))
+    return bool(status)
 
 
 async def _bot_can_restrict(bot: Bot, chat_id: int) -> bool:
+    cached = _bot_restrict_cache.get(chat_id)
+    if cached is not None:
+        return cached
     try:
         bot_member = await bot.get_chat_member(chat_id, bot.id)
-        if bot_member.status != "administrator":
-            return False
-        return bool(getattr(bot_member, "can_restrict_members", False))
     except Exception:
+        # Not cached, like admin lookups: a transient API error should not block mutes for minutes.
         return False
+    can_restrict = bot_member.status == "administrator" and bool(
+        getattr(bot_member, "can_restrict_members", False)
+    )
+    _bot_restrict_cache[chat_id] = can_restrict
+    return can_restrict
 
 
-def _caps_ratio(text: str) -> float:
-    letters = [c for c in text if c.isalpha()]
-    if len(letters) < 10:
-        return 0.0
-    uppercase = sum(1 for c in letters if c.isupper())
-    return uppercase / max(1, len(letters))
-
-
-def _contains_word(text: str, words: set) -> bool:
-    for word in words:
-        if " " in word:
-            if word in text:
-                return True
-        elif re.search(rf"\b{re.escape(word)}\b", text):
-            return True
-    return False
-
-
-def detect_trigger(text: str) -> str:
-    lowered = text.lower()
-    if _caps_ratio(text) > 0.7:
-        return "caps"
-    if re.search(r"[!?]{3,}", text):
-        return "punctuation"
-    if _contains_word(lowered, SELF_HARM_TAUNTS):
-        return "self-harm-taunt"
-    if _contains_word(lowered, SLUR_WORDS):
-        return "slur"
-    if _contains_word(lowered, PROFANITY_WORDS):
-        return "profanity"
-    if _contains_word(lowered, INSULT_WORDS):
-        return "insult"
-    return ""
+def _flood_row(group_id: int, user_id: int) -> int:
+    key = (group_id, user_id)
+    row = _flood_slots.get(key)
+    if row is None:
+        row = len(_flood_slots)
+        capacity = len(_flood_rings) // _FLOOD_STRIDE
+        if row >= capacity:
+            _flood_rings.extend(_FLOOD_EMPTY_ROW * max(capacity, 64))
+        _flood_slots[key] = row
+    return row * _FLOOD_STRIDE
 
 
 def detect_flood(group_id: int, user_id: int, ts: int) -> bool:
-    key = (group_id, user_id)
-    window = _flood_tracker[key]
-    window.append(ts)
-    while window and ts - window[0] > FLOOD_WINDOW_SECONDS:
-        window.popleft()
-    return len(window) > FLOOD_LIMIT
+    rings = _flood_rings
+    base = _flood_row(group_id, user_id)
+    head = rings[base]
+    slot = base + 1 + head
+    # Flooding means the FLOOD_LIMIT-th previous message is still in the window.
+    flooded = ts - rings[slot] <= FLOOD_WINDOW_SECONDS
+    rings[slot] = ts
+    rings[base] = (head + 1) % _FLOOD_RING_SIZE
+    return flooded
+
+
+async def _group_deescalation(text: str, language: str, language_mode: str, flood: bool) -> str:
+    global _group_llm_semaphore
+    key = (text, language, language_mode)
+    cached = _group_deescalation_cache.get(key)
+    if cached is not None:
+        return cached
+    # The same message pasted across chats (or spammed) shares one in-flight completion.
+    pending = _group_deescalation_pending.get(key)
+    if pending is not None:
+        return await asyncio.shield(pending)
+    if _group_llm_semaphore is None:
+        _group_llm_semaphore = asyncio.Semaphore(GROUP_LLM_CONCURRENCY)
+    # When every LLM slot is busy, reply with the template instead of queueing behind slow calls.
+    if _group_llm_semaphore.locked():
+        return _TPL_DEESCALATE_FLOOD if flood else _TPL_DEESCALATE
+
+    pending = asyncio.get_running_loop().create_future()
+    _group_deescalation_pending[key] = pending
+    llm = get_llm_client()
+    try:
+        async with _group_llm_semaphore:
+            responses = await llm.generate_responses(
+                "stabilize",
+                text,
+                language=language,
+                language_mode=language_mode,
+            )
+    except BaseException:
+        pending.cancel()
+        raise
+    finally:
+        del _group_deescalation_pending[key]
+    # A failed or timed-out call comes back as the template; only pin real completions.
+    if not llm.is_template_response(responses, "stabilize"):
+        _group_deescalation_cache[key] = responses[0]
+    pending.set_result(responses[0])
+    return responses[0]
 
 
 def require_group_entitlement(db: DB, group_id: int) -> bool:
@@ -279,20 +516,28 @@ def require_group_rag_entitlement(db: DB, group_id: int) -> bool:
 
 
 async def _maybe_notify_group_entitlement(bot: Bot, group_id: int) -> None:
-    now = int(time.time())
-    last_notice = _group_entitlement_notice_ts.get(group_id, 0)
-    if now - last_notice < 3600:
+    if group_id in _group_entitlement_notice_ts:
         return
     try:
         await bot.send_message(
             chat_id=group_id,
             text="⚠️ Admins: group moderation is disabled until a subscription is active.",
         )
-        _group_entitlement_notice_ts[group_id] = now
+        _group_entitlement_notice_ts[group_id] = int(time.time())
     except Exception as exc:
         logger.warning("Failed to notify group %s about subscription status: %s", group_id, exc)
 
 
+@lru_cache(maxsize=4096)
+def _fmt_minute(ts_minute: int) -> str:
+    return time.strftime("%Y-%m-%d %H:%M", time.gmtime(ts_minute * 60))
+
+
+@lru_cache(maxsize=1024)
+def _fmt_day(ts_day: int) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(ts_day * 86400))
+
+
 def _format_expiry(end_ts: Optional[int], plan_id: Optional[str]) -> str:
     plan = GROUP_PLANS.get(plan_id or "")
     if not plan:
@@ -301,15 +546,16 @@ def _format_expiry(end_ts: Optional[int], plan_id: Optional[str]) -> str:
         return "One-time, non-refundable, lifetime access"
     if not end_ts:
         return "Unknown"
-    return datetime.utcfromtimestamp(end_ts).strftime("%Y-%m-%d")
+    return _fmt_day(end_ts // 86400)
 
 
 def _format_rag_expiry(end_ts: Optional[int]) -> str:
     if not end_ts:
         return "Unknown"
-    return datetime.utcfromtimestamp(end_ts).strftime("%Y-%m-%d")
+    return _fmt_day(end_ts // 86400)
 
 
+@lru_cache(maxsize=64)
 def _format_plan_label(plan_id: Optional[str]) -> str:
     plan = GROUP_PLANS.get(plan_id or "")
     if not plan:
@@ -330,24 +576,54 @@ def render_groupadmin_text(
             "⚠️ <b>V2 Groups are disabled.</b>\n"
             "Group moderation and subscriptions are unavailable.\n"
         )
-    language = group.get("language", "en")
-    mode = group.get("language_mode", "clean")
+    return _render_groupadmin_text_cached(
+        bool(group.get("enabled")),
+        group.get("language", "en"),
+        group.get("language_mode", "clean"),
+        group.get("warn_threshold"),
+        group.get("mute_threshold"),
+        bool(group.get("welcome_enabled")),
+        bool(group.get("rules_enabled")),
+        bool(group.get("security_enabled")),
+        bool(subscription_info.get("active")),
+        subscription_info.get("plan_id"),
+        subscription_info.get("end_ts"),
+        bool(rag_subscription_info.get("active")),
+    )
+
+
+# Keyed on the rendered fields only, like _kb_groupadmin_markup, so repeat saves reuse the text.
+@lru_cache(maxsize=2048)
+def _render_groupadmin_text_cached(
+    enabled: bool,
+    language: str,
+    mode: str,
+    warn_threshold: Optional[int],
+    mute_threshold: Optional[int],
+    welcome_enabled: bool,
+    rules_enabled: bool,
+    security_enabled: bool,
+    subscription_active: bool,
+    plan_id: Optional[str],
+    end_ts: Optional[int],
+    rag_active: bool,
+) -> str:
     language_label = LANGUAGE_LABELS.get(language, language)
     mode_label = LANGUAGE_MODE_LABELS.get(mode, mode.title())
-    subscription_status = "Active" if subscription_info.get("active") else "Inactive"
-    rag_status = "Active" if rag_subscription_info.get("active") else "Inactive"
-    plan_label = _format_plan_label(subscription_info.get("plan_id"))
-    expires = _format_expiry(subscription_info.get("end_ts"), subscription_info.get("plan_id"))
+    subscription_status = "Active" if subscription_active else "Inactive"
+    rag_status = "Active" if rag_active else "Inactive"
+    plan_label = _format_plan_label(plan_id)
+    expires = _format_expiry(end_ts, plan_id)
     return (
         "🛡️ <b>Group Admin Panel</b>\n\n"
-        f"Moderation enabled: {'On' if group.get('enabled') else 'Off'}\n"
+        f"Moderation enabled: {'On' if enabled else 'Off'}\n"
         f"Language: {language_label} ({language})\n"
         f"Language mode: {mode_label}\n"
-        f"Warn threshold: {group.get('warn_threshold')}\n"
-        f"Mute threshold: {group.get('mute_threshold')}\n"
-        f"Welcome: {'On' if group.get('welcome_enabled') else 'Off'}\n"
-        f"Rules: {'On' if group.get('rules_enabled') else 'Off'}\n"
-        f"Security: {'On' if group.get('security_enabled') else 'Off'}\n\n"
+        f"Warn threshold: {warn_threshold}\n"
+        f"Mute threshold: {mute_threshold}\n"
+        f"Welcome: {'On' if welcome_enabled else 'Off'}\n"
+        f"Rules: {'On' if rules_enabled else 'Off'}\n"
+        f"Security: {'On' if security_enabled else 'Off'}\n\n"
         f"Subscription: {subscription_status}\n"
         f"Plan: {plan_label}\n"
         f"Expires: {expires}\n"
@@ -392,15 +668,22 @@ async def _require_group_rag_entitlement_msg(msg: Message, db: DB) -> bool:
 
 
 def _parse_security_config(raw_config: Optional[str]) -> dict:
+    # Callers mutate the result before saving it, so hand out a fresh dict each time.
+    return dict(_parse_security_items(raw_config))
+
+
+# Keyed on the stored JSON text itself: any saved change is a new string, so nothing goes stale.
+@lru_cache(maxsize=2048)
+def _parse_security_items(raw_config: Optional[str]) -> tuple:
     config = SECURITY_DEFAULTS.copy()
     if not raw_config:
-        return config
+        return tuple(config.items())
     try:
-        data = json.loads(raw_config)
-    except json.JSONDecodeError:
-        return config
+        data = jsonutil.loads(raw_config)
+    except jsonutil.JSONDecodeError:
+        return tuple(config.items())
     if not isinstance(data, dict):
-        return config
+        return tuple(config.items())
     if "anti_link" in data:
         config["anti_link"] = bool(data["anti_link"])
     if "anti_spam" in data:
@@ -415,7 +698,7 @@ def _parse_security_config(raw_config: Optional[str]) -> dict:
             config["max_warnings"] = int(data["max_warnings"])
         except (TypeError, ValueError):
             pass
-    return config
+    return tuple(config.items())
 
 
 def _render_security_settings_text(config: dict) -> str:
@@ -429,6 +712,7 @@ def _render_security_settings_text(config: dict) -> str:
     )
 
 
+@lru_cache(maxsize=64)
 def _group_plan_button_text(plan_id: str, fallback: str) -> str:
     plan = GROUP_PLANS.get(plan_id)
     if plan:
@@ -441,57 +725,132 @@ def _group_plan_button_text(plan_id: str, fallback: str) -> str:
     return fallback
 
 
+_GOAL_LABELS = tuple(
+    (goal_key, f"{goal_desc['emoji']} {goal_desc['name']}")
+    for goal_key, goal_desc in GOAL_DESCRIPTIONS.items()
+)
+_GOAL_BUTTONS = tuple((label, f"goal:{goal_key}") for goal_key, label in _GOAL_LABELS)
+_SETTINGS_GOAL_BUTTONS = tuple((label, f"settings:goal:{goal_key}") for goal_key, label in _GOAL_LABELS)
+_SETTINGS_STYLE_BUTTONS = tuple(
+    (style_label, f"settings:style:{style_key}") for style_key, style_label in STYLE_OPTIONS.items()
+)
+_LANGUAGE_LABELS = tuple(
+    (code, f"{LANGUAGE_LABELS.get(code, code)} ({code})") for code in SUPPORTED_LANGUAGES
+)
+_SETTINGS_LANGUAGE_BUTTONS = tuple((label, f"settings:lang:{code}") for code, label in _LANGUAGE_LABELS)
+_GROUP_LANGUAGE_BUTTONS = tuple((label, f"ga:lang:{code}") for code, label in _LANGUAGE_LABELS)
+_MODE_LABELS = tuple((mode, LANGUAGE_MODE_LABELS.get(mode, mode.title())) for mode in LANGUAGE_MODES)
+_SETTINGS_MODE_BUTTONS = tuple((label, f"settings:mode:{mode}") for mode, label in _MODE_LABELS)
+_GROUP_MODE_BUTTONS = tuple((label, f"ga:mode:{mode}") for mode, label in _MODE_LABELS)
+
+
+def _kb_groupadmin_settings_buttons(
+    enabled: bool,
+    warn_threshold: Optional[int],
+    mute_threshold: Optional[int],
+    welcome_enabled: bool,
+    rules_enabled: bool,
+    security_enabled: bool,
+) -> tuple:
+    return (
+        InlineKeyboardButton(
+            text="✅ Enable" if not enabled else "🚫 Disable",
+            callback_data="ga:toggle_enabled",
+        ),
+        InlineKeyboardButton(text="🔎 RAG Query", callback_data="ga:menu:rag"),
+        InlineKeyboardButton(text="🌐 Language", callback_data="ga:menu:language"),
+        InlineKeyboardButton(text="🧭 Mode", callback_data="ga:menu:mode"),
+        InlineKeyboardButton(text=f"Warn threshold ({warn_threshold})", callback_data="ga:menu:warn"),
+        InlineKeyboardButton(text=f"Mute threshold ({mute_threshold})", callback_data="ga:menu:mute"),
+        InlineKeyboardButton(text="✍️ Set Welcome Message", callback_data="ga:menu:set_welcome"),
+        InlineKeyboardButton(text="📜 Set Rules", callback_data="ga:menu:set_rules"),
+        InlineKeyboardButton(text="🛡 Set Security Settings", callback_data="ga:menu:security"),
+        InlineKeyboardButton(
+            text=f"Welcome {'On' if welcome_enabled else 'Off'}",
+            callback_data="ga:toggle:welcome_enabled",
+        ),
+        InlineKeyboardButton(
+            text=f"Rules {'On' if rules_enabled else 'Off'}",
+            callback_data="ga:toggle:rules_enabled",
+        ),
+        InlineKeyboardButton(
+            text=f"Security {'On' if security_enabled else 'Off'}",
+            callback_data="ga:toggle:security_enabled",
+        ),
+    )
+
+
+def _kb_groupadmin_buy_buttons(subscription_active: bool, rag_active: bool) -> tuple:
+    if not subscription_active:
+        return (
+            InlineKeyboardButton(
+                text=_group_plan_button_text("group_monthly", "⭐ Buy Monthly"),
+                callback_data="ga:buy:group_monthly",
+            ),
+            InlineKeyboardButton(
+                text=_group_plan_button_text("group_yearly", "⭐ Buy Yearly"),
+                callback_data="ga:buy:group_yearly",
+            ),
+            InlineKeyboardButton(
+                text=_group_plan_button_text("group_charter", "⭐ Buy Charter"),
+                callback_data="ga:buy:group_charter",
+            ),
+        )
+    if not rag_active:
+        return (
+            InlineKeyboardButton(
+                text=_group_plan_button_text("rag_monthly", "⭐ Buy RAG Add-On"),
+                callback_data="ga:buy:rag_monthly",
+            ),
+        )
+    return ()
+
+
 def kb_groupadmin(group: dict, subscription_info: dict, rag_subscription_info: dict, feature_enabled: bool):
+    if not feature_enabled:
+        return _kb_groupadmin_markup(False, False, None, None, False, False, False, False, False)
+    return _kb_groupadmin_markup(
+        True,
+        bool(group.get("enabled")),
+        group.get("warn_threshold"),
+        group.get("mute_threshold"),
+        bool(group.get("welcome_enabled")),
+        bool(group.get("rules_enabled")),
+        bool(group.get("security_enabled")),
+        bool(subscription_info.get("active")),
+        bool(rag_subscription_info.get("active")),
+    )
+
+
+@lru_cache(maxsize=512)
+def _kb_groupadmin_markup(
+    feature_enabled: bool,
+    enabled: bool,
+    warn_threshold: Optional[int],
+    mute_threshold: Optional[int],
+    welcome_enabled: bool,
+    rules_enabled: bool,
+    security_enabled: bool,
+    subscription_active: bool,
+    rag_active: bool,
+):
     b = InlineKeyboardBuilder()
     if not feature_enabled:
         b.button(text=f"{EMOJIS['back']} Close", callback_data="ga:menu:close")
         b.adjust(1)
         return b.as_markup()
 
-    enabled = bool(group.get("enabled"))
-    b.button(
-        text="✅ Enable" if not enabled else "🚫 Disable",
-        callback_data="ga:toggle_enabled",
-    )
-    b.button(text="🔎 RAG Query", callback_data="ga:menu:rag")
-    b.button(text="🌐 Language", callback_data="ga:menu:language")
-    b.button(text="🧭 Mode", callback_data="ga:menu:mode")
-    b.button(text=f"Warn threshold ({group.get('warn_threshold')})", callback_data="ga:menu:warn")
-    b.button(text=f"Mute threshold ({group.get('mute_threshold')})", callback_data="ga:menu:mute")
-    b.button(text="✍️ Set Welcome Message", callback_data="ga:menu:set_welcome")
-    b.button(text="📜 Set Rules", callback_data="ga:menu:set_rules")
-    b.button(text="🛡 Set Security Settings", callback_data="ga:menu:security")
-    b.button(
-        text=f"Welcome {'On' if group.get('welcome_enabled') else 'Off'}",
-        callback_data="ga:toggle:welcome_enabled",
-    )
-    b.button(
-        text=f"Rules {'On' if group.get('rules_enabled') else 'Off'}",
-        callback_data="ga:toggle:rules_enabled",
-    )
-    b.button(
-        text=f"Security {'On' if group.get('security_enabled') else 'Off'}",
-        callback_data="ga:toggle:security_enabled",
-    )
-
-    if not subscription_info.get("active"):
-        b.button(
-            text=_group_plan_button_text("group_monthly", "⭐ Buy Monthly"),
-            callback_data="ga:buy:group_monthly",
-        )
-        b.button(
-            text=_group_plan_button_text("group_yearly", "⭐ Buy Yearly"),
-            callback_data="ga:buy:group_yearly",
-        )
-        b.button(
-            text=_group_plan_button_text("group_charter", "⭐ Buy Charter"),
-            callback_data="ga:buy:group_charter",
-        )
-    elif not rag_subscription_info.get("active"):
-        b.button(
-            text=_group_plan_button_text("rag_monthly", "⭐ Buy RAG Add-On"),
-            callback_data="ga:buy:rag_monthly",
+    b.add(
+        *_kb_groupadmin_settings_buttons(
+            enabled,
+            warn_threshold,
+            mute_threshold,
+            welcome_enabled,
+            rules_enabled,
+            security_enabled,
         )
+    )
+    b.add(*_kb_groupadmin_buy_buttons(subscription_active, rag_active))
     b.button(text=f"{EMOJIS['back']} Close", callback_data="ga:menu:close")
     b.adjust(2, 2, 2, 2, 2, 2, 2, 2, 1)
     return b.as_markup()
@@ -520,26 +879,27 @@ def kb_group_rag_menu(window_key: str, filter_key: str):
     return b.as_markup()
 
 
+@lru_cache(maxsize=None)
 def kb_group_language_menu():
     b = InlineKeyboardBuilder()
-    for code in SUPPORTED_LANGUAGES:
-        label = LANGUAGE_LABELS.get(code, code)
-        b.button(text=f"{label} ({code})", callback_data=f"ga:lang:{code}")
+    for text, callback_data in _GROUP_LANGUAGE_BUTTONS:
+        b.button(text=text, callback_data=callback_data)
     b.button(text=f"{EMOJIS['back']} Back", callback_data="ga:menu:main")
     b.adjust(2)
     return b.as_markup()
 
 
+@lru_cache(maxsize=None)
 def kb_group_mode_menu():
     b = InlineKeyboardBuilder()
-    for mode in LANGUAGE_MODES:
-        label = LANGUAGE_MODE_LABELS.get(mode, mode.title())
-        b.button(text=f"{label}", callback_data=f"ga:mode:{mode}")
+    for text, callback_data in _GROUP_MODE_BUTTONS:
+        b.button(text=text, callback_data=callback_data)
     b.button(text=f"{EMOJIS['back']} Back", callback_data="ga:menu:main")
     b.adjust(1)
     return b.as_markup()
 
 
+@lru_cache(maxsize=None)
 def kb_group_threshold_menu(threshold_type: str):
     b = InlineKeyboardBuilder()
     if threshold_type == "warn":
@@ -553,6 +913,7 @@ def kb_group_threshold_menu(threshold_type: str):
     return b.as_markup()
 
 
+@lru_cache(maxsize=None)
 def kb_group_text_prompt():
     b = InlineKeyboardBuilder()
     b.button(text=f"{EMOJIS['back']} Back", callback_data="ga:menu:main")
@@ -562,17 +923,32 @@ def kb_group_text_prompt():
 
 
 def kb_group_security_menu(config: dict):
+    return _kb_group_security_markup(
+        bool(config.get("anti_link")),
+        bool(config.get("anti_spam")),
+        config.get("mute_seconds"),
+        config.get("max_warnings"),
+    )
+
+
+@lru_cache(maxsize=256)
+def _kb_group_security_markup(
+    anti_link: bool,
+    anti_spam: bool,
+    mute_seconds: Optional[int],
+    max_warnings: Optional[int],
+):
     b = InlineKeyboardBuilder()
-    link_prefix = "✅" if config.get("anti_link") else "❌"
-    spam_prefix = "✅" if config.get("anti_spam") else "❌"
+    link_prefix = "✅" if anti_link else "❌"
+    spam_prefix = "✅" if anti_spam else "❌"
     b.button(text=f"{link_prefix} Anti-link", callback_data="ga:security:toggle:anti_link")
     b.button(text=f"{spam_prefix} Anti-spam", callback_data="ga:security:toggle:anti_spam")
     b.button(
-        text=f"⏱ Mute seconds ({config.get('mute_seconds')})",
+        text=f"⏱ Mute seconds ({mute_seconds})",
         callback_data="ga:security:set:mute_seconds",
     )
     b.button(
-        text=f"⚠️ Max warnings ({config.get('max_warnings')})",
+        text=f"⚠️ Max warnings ({max_warnings})",
         callback_data="ga:security:set:max_warnings",
     )
     b.button(text=f"{EMOJIS['back']} Back", callback_data="ga:menu:main")
@@ -581,14 +957,12 @@ def kb_group_security_menu(config: dict):
     return b.as_markup()
 
 
+@lru_cache(maxsize=None)
 def kb_goals():
     b = InlineKeyboardBuilder()
 
-    for goal_key, goal_desc in GOAL_DESCRIPTIONS.items():
-        b.button(
-            text=f"{goal_desc['emoji']} {goal_desc['name']}",
-            callback_data=f"goal:{goal_key}",
-        )
+    for text, callback_data in _GOAL_BUTTONS:
+        b.button(text=text, callback_data=callback_data)
 
     b.button(text=f"{EMOJIS['buy']} Pricing", callback_data="nav:pricing")
     b.button(text=f"{EMOJIS['account']} Account", callback_data="nav:account")
@@ -599,6 +973,7 @@ def kb_goals():
     return b.as_markup()
 
 
+@lru_cache(maxsize=None)
 def kb_back_main():
     b = InlineKeyboardBuilder()
     b.button(text=f"{EMOJIS['back']} Back to main menu", callback_data="nav:goals")
@@ -606,6 +981,7 @@ def kb_back_main():
     return b.as_markup()
 
 
+@lru_cache(maxsize=None)
 def kb_after_result():
     b = InlineKeyboardBuilder()
     b.button(text=f"{EMOJIS['retry']} Retry", callback_data="retry:menu")
@@ -615,6 +991,7 @@ def kb_after_result():
     return b.as_markup()
 
 
+@lru_cache(maxsize=None)
 def kb_pricing():
     b = InlineKeyboardBuilder()
     monthly = PERSONAL_PLANS["personal_monthly"]
@@ -628,6 +1005,7 @@ def kb_pricing():
     return b.as_markup()
 
 
+@lru_cache(maxsize=None)
 def kb_retry_menu():
     b = InlineKeyboardBuilder()
     b.button(text="Softer", callback_data="retry:softer")
@@ -639,24 +1017,39 @@ def kb_retry_menu():
 
 
 def kb_settings(user: dict, v2_personal_enabled: bool):
+    if not v2_personal_enabled:
+        # Language buttons are hidden, so every v1 user shares one markup.
+        return _kb_settings_markup(None, None, False, _FEATURE_V2_PERSONAL)
+    return _kb_settings_markup(
+        user.get("language", "en"),
+        user.get("language_mode", "clean"),
+        True,
+        _FEATURE_V2_PERSONAL,
+    )
+
+
+@lru_cache(maxsize=512)
+def _kb_settings_markup(
+    language: Optional[str],
+    language_mode: Optional[str],
+    v2_personal_enabled: bool,
+    feature_v2_personal: bool,
+):
     b = InlineKeyboardBuilder()
-    for goal_key, goal_desc in GOAL_DESCRIPTIONS.items():
-        b.button(
-            text=f"{goal_desc['emoji']} {goal_desc['name']}",
-            callback_data=f"settings:goal:{goal_key}",
-        )
+    for text, callback_data in _SETTINGS_GOAL_BUTTONS:
+        b.button(text=text, callback_data=callback_data)
     b.button(text="❌ None", callback_data="settings:goal:none")
 
-    for style_key, style_label in STYLE_OPTIONS.items():
-        b.button(text=style_label, callback_data=f"settings:style:{style_key}")
+    for text, callback_data in _SETTINGS_STYLE_BUTTONS:
+        b.button(text=text, callback_data=callback_data)
     b.button(text="❌ None", callback_data="settings:style:none")
 
     if v2_personal_enabled:
-        language_label = LANGUAGE_LABELS.get(user.get("language", "en"), "English")
-        mode_label = LANGUAGE_MODE_LABELS.get(user.get("language_mode", "clean"), "Clean")
+        language_label = LANGUAGE_LABELS.get(language, "English")
+        mode_label = LANGUAGE_MODE_LABELS.get(language_mode, "Clean")
         b.button(text=f"🌐 Language: {language_label}", callback_data="settings:menu:language")
         b.button(text=f"🧭 Mode: {mode_label}", callback_data="settings:menu:mode")
-    if settings.feature_v2_personal:
+    if feature_v2_personal:
         toggle_label = "Disable" if v2_personal_enabled else "Enable"
         b.button(text=f"🧪 {toggle_label} V2 Personal", callback_data=f"settings:v2:{toggle_label.lower()}")
 
@@ -665,21 +1058,21 @@ def kb_settings(user: dict, v2_personal_enabled: bool):
     return b.as_markup()
 
 
+@lru_cache(maxsize=None)
 def kb_language_menu():
     b = InlineKeyboardBuilder()
-    for code in SUPPORTED_LANGUAGES:
-        label = LANGUAGE_LABELS.get(code, code)
-        b.button(text=f"{label} ({code})", callback_data=f"settings:lang:{code}")
+    for text, callback_data in _SETTINGS_LANGUAGE_BUTTONS:
+        b.button(text=text, callback_data=callback_data)
     b.button(text=f"{EMOJIS['back']} Back", callback_data="settings:menu:main")
     b.adjust(2)
     return b.as_markup()
 
 
+@lru_cache(maxsize=None)
 def kb_language_mode_menu():
     b = InlineKeyboardBuilder()
-    for mode in LANGUAGE_MODES:
-        label = LANGUAGE_MODE_LABELS.get(mode, mode.title())
-        b.button(text=f"{label}", callback_data=f"settings:mode:{mode}")
+    for text, callback_data in _SETTINGS_MODE_BUTTONS:
+        b.button(text=text, callback_data=callback_data)
     b.button(text=f"{EMOJIS['back']} Back", callback_data="settings:menu:main")
     b.adjust(1)
     return b.as_markup()
@@ -715,6 +1108,25 @@ def render_settings_text(user: dict, v2_personal_enabled: bool) -> str:
     )
 
 
+def _settings_view(user: dict):
+    v2_personal_enabled = _FEATURE_V2_PERSONAL and bool(user.get("v2_enabled"))
+    return (
+        render_settings_text(user, v2_personal_enabled),
+        kb_settings(user, v2_personal_enabled),
+    )
+
+
+def _account_text(db: DB, user_id: int) -> str:
+    account = db.get_account_bundle(user_id)
+    return ACCOUNT_TEMPLATE.format(
+        paid_resolves=account["resolves_remaining"],
+        free_status="Available" if account["free_available"] else "Used today",
+        total_uses=account["total_interactions"],
+        account_age=account["account_age_days"],
+    )
+
+
+@lru_cache(maxsize=None)
 def kb_change_goal():
     b = InlineKeyboardBuilder()
     b.button(text="Change goal", callback_data="nav:goals")
@@ -723,11 +1135,20 @@ def kb_change_goal():
     return b.as_markup()
 
 
+_UNKNOWN_COMMANDS_TEXT = "\n".join(
+    ["I didn't understand that. Try:"]
+    + [f"/{command} - {description}" for command, description in BOT_COMMANDS]
+)
+
+
 def render_unknown_commands() -> str:
-    lines = ["I didn't understand that. Try:"]
-    for command, description in BOT_COMMANDS:
-        lines.append(f"/{command} - {description}")
-    return "\n".join(lines)
+    return _UNKNOWN_COMMANDS_TEXT
+
+
+def _feedback_meta_json(source: str, chat_id: int, message_id: int) -> str:
+    # source is one of our own ASCII constants and the ids are Telegram ints,
+    # so the payload can be written directly without going through json.dumps.
+    return f'{{"source": "{source}", "chat_id": {int(chat_id)}, "message_id": {int(message_id)}}}'
 
 
 @router.message(Command("start"))
@@ -777,10 +1198,10 @@ async def cmd_pricing(msg: Message):
 @router.message(Command("buy"))
 async def cmd_buy(msg: Message, command: CommandObject, bot: Bot, db: DB):
     plan_id = (command.args or "").strip().lower()
-    if plan_id in PERSONAL_PLANS:
-        plan = PERSONAL_PLANS[plan_id]
+    plan = PERSONAL_PLANS.get(plan_id)
+    if plan:
         if not _should_allow_xtr_amount(plan.id, plan.stars, plan.stars, "XTR"):
-            await msg.answer("Pricing misconfigured. Please contact admin.")
+            await msg.answer(_PRICING_MISCONFIGURED_TEXT)
             return
         payload = _create_invoice_record(
             db=db,
@@ -789,7 +1210,7 @@ async def cmd_buy(msg: Message, command: CommandObject, bot: Bot, db: DB):
             amount=plan.stars,
         )
         if not payload:
-            await msg.answer("Failed to create invoice. Please try again.")
+            await msg.answer(_INVOICE_FAILED_TEXT)
             return
 
         logger.info(
@@ -798,29 +1219,16 @@ async def cmd_buy(msg: Message, command: CommandObject, bot: Bot, db: DB):
             plan.stars,
             len(payload),
         )
-        prices = [LabeledPrice(label=f"{plan.resolves} Resolves (Personal)", amount=plan.stars)]
         try:
             await bot.send_invoice(
                 chat_id=msg.from_user.id,
-                title=f"Personal {plan.name} - The Resolver",
-                description=f"Personal (DM) plan: {plan.resolves} resolve(s).",
                 payload=payload,
-                provider_token="",
-                currency="XTR",
-                prices=prices,
-                start_parameter="resolver_bot",
-                need_email=False,
-                need_name=False,
-                need_phone_number=False,
-                need_shipping_address=False,
-                is_flexible=False,
-                disable_notification=True,
-                protect_content=False,
+                **_PERSONAL_INVOICES[plan.id],
             )
             return
         except Exception as exc:
             logger.error("Failed to send invoice: %s", exc)
-            await msg.answer("Failed to create invoice. Please try again.")
+            await msg.answer(_INVOICE_FAILED_TEXT)
             return
 
     await msg.answer(PRICING_TEXT, reply_markup=kb_pricing())
@@ -833,34 +1241,13 @@ async def cmd_help(msg: Message):
 
 @router.message(Command("account"))
 async def cmd_account(msg: Message, db: DB):
-    user_id = msg.from_user.id
-    db.ensure_user(user_id)
-
-    user = db.get_user(user_id)
-    stats = db.get_user_stats(user_id)
-
-    free_status = "Available" if db.can_use_free_today(user_id) else "Used today"
-
-    text = ACCOUNT_TEMPLATE.format(
-        paid_resolves=user.get("resolves_remaining", 0),
-        free_status=free_status,
-        total_uses=stats.get("total_interactions", 0),
-        account_age=stats.get("account_age_days", 0),
-    )
-
-    await msg.answer(text, reply_markup=kb_back_main())
+    await msg.answer(_account_text(db, msg.from_user.id), reply_markup=kb_back_main())
 
 
 @router.message(Command("settings"))
 async def cmd_settings(msg: Message, db: DB):
-    user_id = msg.from_user.id
-    db.ensure_user(user_id)
-    user = db.get_user(user_id)
-    v2_personal_enabled = settings.feature_v2_personal and bool(user.get("v2_enabled"))
-    await msg.answer(
-        render_settings_text(user, v2_personal_enabled),
-        reply_markup=kb_settings(user, v2_personal_enabled),
-    )
+    text, markup = _settings_view(db.get_user(msg.from_user.id))
+    await msg.answer(text, reply_markup=markup)
 
 
 @router.message(Command("feedback"))
@@ -868,13 +1255,7 @@ async def cmd_feedback(msg: Message, command: CommandObject, state: FSMContext,
     await state.clear()
     feedback = command.args
     if feedback:
-        meta_json = json.dumps(
-            {
-                "source": "command",
-                "chat_id": msg.chat.id,
-                "message_id": msg.message_id,
-            }
-        )
+        meta_json = _feedback_meta_json("command", msg.chat.id, msg.message_id)
         db.add_feedback(msg.from_user.id, feedback.strip(), meta_json)
         logger.info(
             "Feedback received from user %s (length=%s)",
@@ -906,29 +1287,14 @@ async def nav_handler(cb: CallbackQuery, state: FSMContext, db: DB):
     elif action == "help":
         await _edit_or_send(cb.message, _maybe_add_fallback(HELP_TEXT), reply_markup=kb_back_main())
     elif action == "settings":
-        user_id = cb.from_user.id
-        db.ensure_user(user_id)
-        user = db.get_user(user_id)
-        v2_personal_enabled = settings.feature_v2_personal and bool(user.get("v2_enabled"))
+        text, markup = _settings_view(db.get_user(cb.from_user.id))
+        await _edit_or_send(cb.message, text, reply_markup=markup)
+    elif action == "account":
         await _edit_or_send(
             cb.message,
-            render_settings_text(user, v2_personal_enabled),
-            reply_markup=kb_settings(user, v2_personal_enabled),
-        )
-    elif action == "account":
-        user_id = cb.from_user.id
-        db.ensure_user(user_id)
-        user = db.get_user(user_id)
-        stats = db.get_user_stats(user_id)
-        free_status = "Available" if db.can_use_free_today(user_id) else "Used today"
-
-        text = ACCOUNT_TEMPLATE.format(
-            paid_resolves=user.get("resolves_remaining", 0),
-            free_status=free_status,
-            total_uses=stats.get("total_interactions", 0),
-            account_age=stats.get("account_age_days", 0),
+            _account_text(db, cb.from_user.id),
+            reply_markup=kb_back_main(),
         )
-        await _edit_or_send(cb.message, text, reply_markup=kb_back_main())
     else:
         await state.clear()
         await _edit_or_send(cb.message, "Choose a goal:", reply_markup=kb_goals())
@@ -952,12 +1318,23 @@ async def choose_goal(cb: CallbackQuery, state: FSMContext, db: DB):
 
 @router.callback_query(F.data.startswith("settings:"))
 async def settings_handler(cb: CallbackQuery, db: DB):
+    if _is_repeat_callback(cb):
+        await cb.answer()
+        return
     _, setting, value = cb.data.split(":", 2)
+    if not _FEATURE_V2_PERSONAL and (
+        setting in _V2_PERSONAL_SETTINGS or (setting == "menu" and value in _V2_PERSONAL_MENUS)
+    ):
+        await cb.answer("V2 personal is disabled.")
+        return
     user_id = cb.from_user.id
-    db.ensure_user(user_id)
-
-    user = db.get_user(user_id)
-    v2_personal_enabled = settings.feature_v2_personal and bool(user.get("v2_enabled"))
+    # Writes render from the row update_user_setting returns; menus, the v2-gated writes and
+    # the no-op checks for goal/style/lang/mode need the current row up front.
+    user = None
+    v2_personal_enabled = False
+    if setting in _SETTINGS_READ_USER:
+        user = db.get_user(user_id)
+        v2_personal_enabled = _FEATURE_V2_PERSONAL and bool(user.get("v2_enabled"))
 
     if setting == "menu":
         if value == "language":
@@ -983,75 +1360,65 @@ async def settings_handler(cb: CallbackQuery, db: DB):
             await cb.answer()
             return
         if value == "main":
-            await _edit_or_send(
-                cb.message,
-                render_settings_text(user, v2_personal_enabled),
-                reply_markup=kb_settings(user, v2_personal_enabled),
-            )
+            text, markup = _settings_view(user)
+            await _edit_or_send(cb.message, text, reply_markup=markup)
             await cb.answer()
             return
     if setting == "goal":
-        goal_value = None if value == "none" else value
-        if goal_value is not None and goal_value not in GOAL_DESCRIPTIONS:
+        field, new_value = "default_goal", None if value == "none" else value
+        if new_value is not None and new_value not in GOAL_DESCRIPTIONS:
             await cb.answer("Unknown goal option.")
             return
-        db.set_default_goal(user_id, goal_value)
     elif setting == "style":
-        style_value = None if value == "none" else value
-        if style_value is not None and style_value not in STYLE_OPTIONS:
+        field, new_value = "default_style", None if value == "none" else value
+        if new_value is not None and new_value not in STYLE_OPTIONS:
             await cb.answer("Unknown style option.")
             return
-        db.set_default_style(user_id, style_value)
     elif setting == "v2":
-        if not settings.feature_v2_personal:
-            await cb.answer("V2 personal is disabled.")
-            return
-        enable_v2 = value == "enable"
-        db.set_v2_enabled(user_id, enable_v2)
-        user = db.get_user(user_id)
-        v2_personal_enabled = settings.feature_v2_personal and bool(user.get("v2_enabled"))
+        field, new_value = "v2_enabled", 1 if value == "enable" else 0
     elif setting == "lang":
         if not v2_personal_enabled:
             await cb.answer("V2 personal is disabled.")
             return
-        if value not in SUPPORTED_LANGUAGES:
+        if value not in _SUPPORTED_LANGUAGE_SET:
             await cb.answer("Unknown language.")
             return
-        db.set_language(user_id, value)
+        field, new_value = "language", value
     elif setting == "mode":
         if not v2_personal_enabled:
             await cb.answer("V2 personal is disabled.")
             return
-        if value not in LANGUAGE_MODES:
+        if value not in _LANGUAGE_MODE_SET:
             await cb.answer("Unknown language mode.")
             return
-        db.set_language_mode(user_id, value)
+        field, new_value = "language_mode", value
     else:
         await cb.answer("Unknown setting.")
         return
 
-    user = db.get_user(user_id)
-    await _edit_or_send(
-        cb.message,
-        render_settings_text(user, v2_personal_enabled),
-        reply_markup=kb_settings(user, v2_personal_enabled),
-    )
+    # Re-selecting the current value: no write and no edit, like the group admin panel.
+    if user is not None and user.get(field) == new_value:
+        await cb.answer(_NO_CHANGE_TEXT)
+        return
+    user = db.update_user_setting(user_id, field, new_value)
+
+    text, markup = _settings_view(user)
+    await _edit_or_send(cb.message, text, reply_markup=markup)
     await cb.answer("Settings saved.")
 
 
 @router.message(Flow.waiting_for_text)
-async def on_text_input(msg: Message, state: FSMContext, db: DB):
+async def on_text_input(msg: Message, state: FSMContext, db: DB, writer: LogWriter):
     if not msg.text:
         await msg.answer("Please send text so I can help.")
         return
 
     user_id = msg.from_user.id
     text = msg.text.strip()
+    max_length = settings.max_input_length
 
-    if len(text) > settings.max_input_length:
-        await msg.answer(
-            ERROR_MESSAGES["invalid_input"].format(max_length=settings.max_input_length)
-        )
+    if len(text) > max_length:
+        await msg.answer(ERROR_MESSAGES["invalid_input"].format(max_length=max_length))
         return
 
     user = db.get_user(user_id)
@@ -1083,10 +1450,9 @@ async def on_text_input(msg: Message, state: FSMContext, db: DB):
             language=language,
             language_mode=language_mode,
         )
-        db.log_interaction(user_id, goal, text, responses, used_paid=True)
+        writer.log_interaction(user_id, goal, text, responses, used_paid=True)
 
-        await typing_msg.delete()
-        await msg.answer(render_options(*responses), reply_markup=kb_after_result())
+        await _edit_or_send(typing_msg, render_options(*responses), reply_markup=kb_after_result())
         return
 
     if goal == "stabilize" and db.can_use_free_today(user_id):
@@ -1102,10 +1468,9 @@ async def on_text_input(msg: Message, state: FSMContext, db: DB):
             language=language,
             language_mode=language_mode,
         )
-        db.log_interaction(user_id, goal, text, responses, used_paid=False)
+        writer.log_interaction(user_id, goal, text, responses, used_paid=False)
 
-        await typing_msg.delete()
-        await msg.answer(render_options(*responses), reply_markup=kb_after_result())
+        await _edit_or_send(typing_msg, render_options(*responses), reply_markup=kb_after_result())
         return
 
     await msg.answer(ERROR_MESSAGES["no_resolves"], reply_markup=kb_pricing())
@@ -1122,13 +1487,7 @@ async def on_feedback_message(msg: Message, state: FSMContext, db: DB):
         await msg.answer("Please send your feedback as text.")
         return
 
-    meta_json = json.dumps(
-        {
-            "source": "flow",
-            "chat_id": msg.chat.id,
-            "message_id": msg.message_id,
-        }
-    )
+    meta_json = _feedback_meta_json("flow", msg.chat.id, msg.message_id)
     db.add_feedback(msg.from_user.id, feedback, meta_json)
     logger.info(
         "Feedback received from user %s (length=%s)",
@@ -1146,16 +1505,15 @@ async def cmd_groupadmin(msg: Message, bot: Bot, db: DB):
         await msg.answer("This command can only be used in groups.")
         return
     if not await is_group_admin(bot, msg.chat.id, msg.from_user.id):
-        await msg.answer("This command is restricted to group admins.")
+        await msg.answer(_ADMIN_ONLY_TEXT)
         return
 
-    group = db.get_group_settings(msg.chat.id)
-    subscription_info = db.get_group_subscription_info(msg.chat.id)
-    rag_subscription_info = db.get_group_rag_subscription_info(msg.chat.id)
-    text = render_groupadmin_text(group, subscription_info, rag_subscription_info, settings.feature_v2_groups)
+    feature_enabled = _FEATURE_V2_GROUPS
+    group, subscription_info, rag_subscription_info = db.get_group_bundle(msg.chat.id)
+    text = render_groupadmin_text(group, subscription_info, rag_subscription_info, feature_enabled)
     await msg.answer(
         text,
-        reply_markup=kb_groupadmin(group, subscription_info, rag_subscription_info, settings.feature_v2_groups),
+        reply_markup=kb_groupadmin(group, subscription_info, rag_subscription_info, feature_enabled),
     )
 
 
@@ -1165,9 +1523,9 @@ async def cmd_grouplogs(msg: Message, bot: Bot, db: DB):
         await msg.answer("This command can only be used in groups.")
         return
     if not await is_group_admin(bot, msg.chat.id, msg.from_user.id):
-        await msg.answer("This command is restricted to group admins.")
+        await msg.answer(_ADMIN_ONLY_TEXT)
         return
-    if not settings.feature_v2_groups:
+    if not _FEATURE_V2_GROUPS:
         await msg.answer("V2 groups are disabled.")
         return
 
@@ -1178,7 +1536,7 @@ async def cmd_grouplogs(msg: Message, bot: Bot, db: DB):
 
     lines = ["🧾 <b>Moderation Logs</b> (last 20):\n"]
     for entry in logs:
-        ts = datetime.utcfromtimestamp(entry["ts"]).strftime("%Y-%m-%d %H:%M")
+        ts = _fmt_minute(entry["ts"] // 60)
         trigger = entry.get("trigger", "unknown")
         action = entry.get("action", "none")
         user_id = entry.get("user_id")
@@ -1186,490 +1544,531 @@ async def cmd_grouplogs(msg: Message, bot: Bot, db: DB):
     await msg.answer("\n".join(lines))
 
 
-@router.callback_query(F.data.startswith("ga:"))
-async def groupadmin_handler(cb: CallbackQuery, bot: Bot, db: DB, state: FSMContext):
-    if not cb.message:
-        await cb.answer()
-        return
-
-    if cb.message.chat.type not in {"group", "supergroup"}:
-        await cb.answer("Group-only command.")
-        return
+# Admin panel actions that only swap in a fixed submenu: action -> (text, keyboard builder).
+_GA_STATIC_MENUS = {
+    "menu:close": ("Admin panel closed.", None),
+    "menu:language": ("Choose group language:", kb_group_language_menu),
+    "menu:mode": ("Choose group language mode:", kb_group_mode_menu),
+    "menu:warn": ("Set warning threshold:", partial(kb_group_threshold_menu, "warn")),
+    "menu:mute": ("Set mute threshold:", partial(kb_group_threshold_menu, "mute")),
+}
 
-    if not await is_group_admin(bot, cb.message.chat.id, cb.from_user.id):
-        await cb.answer("This command is restricted to group admins.")
-        return
+_RAG_MENU_TEXT = "Ask a question about this group's moderation history."
+
+
+class _GaAction(NamedTuple):
+    """A ``ga:<prefix>:<sub_action>:<sub_arg>`` callback split once up front."""
+
+    action: str
+    prefix: str
+    arg: str
+    sub_action: str
+    sub_arg: str
+
+    @classmethod
+    def parse(cls, data: str) -> "_GaAction":
+        action = data.partition(":")[2]
+        prefix, _, arg = action.partition(":")
+        sub_action, _, sub_arg = arg.partition(":")
+        return cls(action, prefix, arg, sub_action, sub_arg)
+
+
+class _GroupAdminCtx:
+    """One admin panel callback: the parsed action plus a lazily loaded group bundle."""
+
+    def __init__(
+        self,
+        cb: CallbackQuery,
+        bot: Bot,
+        db: DB,
+        writer: LogWriter,
+        state: FSMContext,
+        group_id: int,
+        act: _GaAction,
+    ):
+        self.cb = cb
+        self.bot = bot
+        self.db = db
+        self.writer = writer
+        self.state = state
+        self.group_id = group_id
+        self.action, self.prefix, self.arg, self.sub_action, self.sub_arg = act
+        # Callback answer shown after a handler asks for the panel to be re-rendered.
+        self.notice = "Saved."
+
+    @cached_property
+    def bundle(self) -> tuple:
+        return self.db.get_group_bundle(self.group_id)
+
+    @property
+    def group(self) -> dict:
+        return self.bundle[0]
+
+    def audit(self, action: str, reason: str, metadata: dict) -> None:
+        self.writer.record_audit_event(
+            chat_id=self.group_id,
+            actor_user_id=self.cb.from_user.id,
+            action=action,
+            reason=reason,
+            metadata=metadata,
+        )
 
-    group_id = cb.message.chat.id
-    group = db.get_group_settings(group_id)
-    if not settings.feature_v2_groups and cb.data not in {"ga:menu:close"}:
+    async def show_panel(self) -> None:
+        group, subscription_info, rag_subscription_info = self.bundle
         await _edit_message(
-            cb.message,
-            render_groupadmin_text({}, {}, {}, False),
-            reply_markup=kb_groupadmin({}, {}, {}, False),
+            self.cb.message,
+            render_groupadmin_text(group, subscription_info, rag_subscription_info, True),
+            reply_markup=kb_groupadmin(group, subscription_info, rag_subscription_info, True),
         )
-        await cb.answer()
-        return
 
-    action = cb.data.split(":", 1)[1]
+    async def show_rag_menu(
+        self,
+        text: str = _RAG_MENU_TEXT,
+        window_key: Optional[str] = None,
+        filter_key: Optional[str] = None,
+    ) -> None:
+        if window_key is None or filter_key is None:
+            data = await self.state.get_data()
+            window_key = window_key or data.get("rag_window", "24h")
+            filter_key = filter_key or data.get("rag_filter", "incidents")
+        await _edit_message(self.cb.message, text, reply_markup=kb_group_rag_menu(window_key, filter_key))
 
-    if action == "menu:close":
-        await _edit_message(cb.message, "Admin panel closed.")
-        await cb.answer()
-        return
-    if action == "menu:main":
-        await state.clear()
-        subscription_info = db.get_group_subscription_info(group_id)
-        rag_subscription_info = db.get_group_rag_subscription_info(group_id)
-        await _edit_message(
-            cb.message,
-            render_groupadmin_text(group, subscription_info, rag_subscription_info, settings.feature_v2_groups),
-            reply_markup=kb_groupadmin(group, subscription_info, rag_subscription_info, settings.feature_v2_groups),
-        )
-        await cb.answer()
-        return
-    if action == "flow:cancel":
-        await state.clear()
-        subscription_info = db.get_group_subscription_info(group_id)
-        rag_subscription_info = db.get_group_rag_subscription_info(group_id)
-        await _edit_message(
-            cb.message,
-            render_groupadmin_text(group, subscription_info, rag_subscription_info, settings.feature_v2_groups),
-            reply_markup=kb_groupadmin(group, subscription_info, rag_subscription_info, settings.feature_v2_groups),
-        )
-        await cb.answer("Canceled.")
-        return
-    if action == "menu:language":
-        await _edit_message(cb.message, "Choose group language:", reply_markup=kb_group_language_menu())
-        await cb.answer()
-        return
-    if action == "menu:mode":
-        await _edit_message(cb.message, "Choose group language mode:", reply_markup=kb_group_mode_menu())
-        await cb.answer()
-        return
-    if action == "menu:warn":
-        await _edit_message(
-            cb.message,
-            "Set warning threshold:",
-            reply_markup=kb_group_threshold_menu("warn"),
-        )
-        await cb.answer()
-        return
-    if action == "menu:mute":
-        await _edit_message(
-            cb.message,
-            "Set mute threshold:",
-            reply_markup=kb_group_threshold_menu("mute"),
-        )
-        await cb.answer()
-        return
-    if action == "menu:rag":
-        if not await _require_group_rag_entitlement_cb(cb, db, group_id):
-            return
-        data = await state.get_data()
-        window_key = data.get("rag_window", "24h")
-        filter_key = data.get("rag_filter", "incidents")
-        await _edit_message(
-            cb.message,
-            "Ask a question about this group's moderation history.",
-            reply_markup=kb_group_rag_menu(window_key, filter_key),
-        )
-        await cb.answer()
-        return
-    if action == "menu:set_welcome":
-        if not await _require_group_entitlement_cb(cb, db, group_id):
-            return
-        await state.clear()
-        await state.update_data(group_id=group_id)
-        await state.set_state(Flow.waiting_for_welcome_message)
-        await _edit_message(
-            cb.message,
-            "Send the welcome message text to save for this group.",
-            reply_markup=kb_group_text_prompt(),
-        )
-        await cb.answer()
-        return
-    if action == "menu:set_rules":
-        if not await _require_group_entitlement_cb(cb, db, group_id):
-            return
-        await state.clear()
-        await state.update_data(group_id=group_id)
-        await state.set_state(Flow.waiting_for_rules_text)
-        await _edit_message(
-            cb.message,
-            "Send the rules text to save for this group.",
-            reply_markup=kb_group_text_prompt(),
-        )
-        await cb.answer()
-        return
-    if action == "menu:security":
-        if not await _require_group_entitlement_cb(cb, db, group_id):
-            return
-        await state.clear()
-        config = _parse_security_config(group.get("security_config_json"))
-        await _edit_message(
-            cb.message,
-            _render_security_settings_text(config),
-            reply_markup=kb_group_security_menu(config),
-        )
-        await cb.answer()
-        return
-    if action.startswith("security:toggle:"):
-        if not await _require_group_entitlement_cb(cb, db, group_id):
-            return
-        key = action.split(":", 2)[2]
-        if key not in {"anti_link", "anti_spam"}:
-            await cb.answer("Unknown security option.")
-            return
-        config = _parse_security_config(group.get("security_config_json"))
-        config[key] = not bool(config.get(key))
-        db.set_group_security_config(group_id, json.dumps(config))
-        db.record_audit_event(
-            chat_id=group_id,
-            actor_user_id=cb.from_user.id,
-            action="group_setting_update",
-            reason="security_config",
-            metadata={"field": key, "new": config[key]},
-        )
-        await _edit_message(
-            cb.message,
-            _render_security_settings_text(config),
-            reply_markup=kb_group_security_menu(config),
-        )
-        await cb.answer("Updated.")
-        return
-    if action.startswith("security:set:"):
-        if not await _require_group_entitlement_cb(cb, db, group_id):
-            return
-        field = action.split(":", 2)[2]
-        if field not in {"mute_seconds", "max_warnings"}:
-            await cb.answer("Unknown security option.")
-            return
-        await state.clear()
-        await state.update_data(group_id=group_id, security_field=field)
-        await state.set_state(Flow.waiting_for_security_value)
-        prompt = "Send the mute duration in seconds." if field == "mute_seconds" else "Send the max warnings count."
-        await _edit_message(cb.message, prompt, reply_markup=kb_group_text_prompt())
-        await cb.answer()
-        return
-    if action == "toggle_enabled":
-        current = bool(group.get("enabled"))
-        db.set_group_enabled(group_id, not current)
-        db.record_audit_event(
-            chat_id=group_id,
-            actor_user_id=cb.from_user.id,
-            action="group_setting_toggle",
-            reason="enabled",
-            metadata={"field": "enabled", "old": current, "new": not current},
-        )
-    elif action.startswith("toggle:"):
-        field = action.split(":", 1)[1]
-        current = bool(group.get(field))
-        db.set_group_toggle(group_id, field, not current)
-        db.record_audit_event(
-            chat_id=group_id,
-            actor_user_id=cb.from_user.id,
-            action="group_setting_toggle",
-            reason=field,
-            metadata={"field": field, "old": current, "new": not current},
-        )
-    elif action.startswith("lang:"):
-        language = action.split(":", 1)[1]
-        if language not in SUPPORTED_LANGUAGES:
-            await cb.answer("Unknown language.")
-            return
-        db.set_group_language(group_id, language)
-        db.record_audit_event(
-            chat_id=group_id,
-            actor_user_id=cb.from_user.id,
-            action="group_setting_update",
-            reason="language",
-            metadata={"field": "language", "old": group.get("language"), "new": language},
-        )
-    elif action.startswith("mode:"):
-        mode = action.split(":", 1)[1]
-        if mode not in LANGUAGE_MODES:
-            await cb.answer("Unknown mode.")
-            return
-        db.set_group_language_mode(group_id, mode)
-        db.record_audit_event(
-            chat_id=group_id,
-            actor_user_id=cb.from_user.id,
-            action="group_setting_update",
-            reason="language_mode",
-            metadata={"field": "language_mode", "old": group.get("language_mode"), "new": mode},
-        )
-    elif action.startswith("warn:"):
-        try:
-            value = int(action.split(":", 1)[1])
-        except ValueError:
-            await cb.answer("Invalid value.")
-            return
-        mute_threshold = group.get("mute_threshold", 3)
-        if value >= mute_threshold:
-            await cb.answer("Warn threshold must be less than mute threshold.")
-            return
-        db.set_group_thresholds(group_id, value, mute_threshold)
-        db.record_audit_event(
-            chat_id=group_id,
-            actor_user_id=cb.from_user.id,
-            action="group_setting_update",
-            reason="warn_threshold",
-            metadata={
-                "field": "warn_threshold",
-                "old": group.get("warn_threshold"),
-                "new": value,
-            },
-        )
-    elif action.startswith("mute:"):
-        try:
-            value = int(action.split(":", 1)[1])
-        except ValueError:
-            await cb.answer("Invalid value.")
-            return
-        warn_threshold = group.get("warn_threshold", 2)
-        if value <= warn_threshold:
-            await cb.answer("Mute threshold must be greater than warn threshold.")
-            return
-        db.set_group_thresholds(group_id, warn_threshold, value)
-        db.record_audit_event(
-            chat_id=group_id,
-            actor_user_id=cb.from_user.id,
-            action="group_setting_update",
-            reason="mute_threshold",
-            metadata={
-                "field": "mute_threshold",
-                "old": group.get("mute_threshold"),
-                "new": value,
-            },
-        )
-    elif action.startswith("rag:window:"):
-        if not await _require_group_rag_entitlement_cb(cb, db, group_id):
-            return
-        window_key = action.split(":", 2)[2]
+
+# Each admin panel action handler either answers the callback itself and returns
+# False, or applies a settings change and returns True so groupadmin_handler
+# re-renders the panel and answers "Saved.".
+
+
+async def _ga_menu_main(ctx: _GroupAdminCtx) -> bool:
+    await ctx.state.clear()
+    await ctx.show_panel()
+    await ctx.cb.answer()
+    return False
+
+
+async def _ga_flow_cancel(ctx: _GroupAdminCtx) -> bool:
+    await ctx.state.clear()
+    await ctx.show_panel()
+    await ctx.cb.answer("Canceled.")
+    return False
+
+
+async def _ga_menu_rag(ctx: _GroupAdminCtx) -> bool:
+    if not await _require_group_rag_entitlement_cb(ctx.cb, ctx.db, ctx.group_id):
+        return False
+    await ctx.show_rag_menu()
+    await ctx.cb.answer()
+    return False
+
+
+async def _ga_text_prompt(ctx: _GroupAdminCtx, flow_state, prompt: str) -> bool:
+    if not await _require_group_entitlement_cb(ctx.cb, ctx.db, ctx.group_id):
+        return False
+    await ctx.state.clear()
+    await ctx.state.update_data(group_id=ctx.group_id)
+    await ctx.state.set_state(flow_state)
+    await _edit_message(ctx.cb.message, prompt, reply_markup=kb_group_text_prompt())
+    await ctx.cb.answer()
+    return False
+
+
+async def _ga_menu_security(ctx: _GroupAdminCtx) -> bool:
+    if not await _require_group_entitlement_cb(ctx.cb, ctx.db, ctx.group_id):
+        return False
+    await ctx.state.clear()
+    config = _parse_security_config(ctx.group.get("security_config_json"))
+    await _edit_message(
+        ctx.cb.message,
+        _render_security_settings_text(config),
+        reply_markup=kb_group_security_menu(config),
+    )
+    await ctx.cb.answer()
+    return False
+
+
+async def _ga_security(ctx: _GroupAdminCtx) -> bool:
+    if ctx.sub_action not in {"toggle", "set"}:
+        await ctx.cb.answer("Unknown action.")
+        return False
+    if not await _require_group_entitlement_cb(ctx.cb, ctx.db, ctx.group_id):
+        return False
+    if ctx.sub_action == "set":
+        field = ctx.sub_arg
+        if field not in _SECURITY_FIELDS:
+            await ctx.cb.answer("Unknown security option.")
+            return False
+        await ctx.state.clear()
+        await ctx.state.update_data(group_id=ctx.group_id, security_field=field)
+        await ctx.state.set_state(Flow.waiting_for_security_value)
+        prompt = "Send the mute duration in seconds." if field == "mute_seconds" else "Send the max warnings count."
+        await _edit_message(ctx.cb.message, prompt, reply_markup=kb_group_text_prompt())
+        await ctx.cb.answer()
+        return False
+
+    key = ctx.sub_arg
+    if key not in _SECURITY_TOGGLES:
+        await ctx.cb.answer("Unknown security option.")
+        return False
+    config = _parse_security_config(ctx.group.get("security_config_json"))
+    config[key] = not bool(config.get(key))
+    ctx.db.set_group_security_config(ctx.group_id, jsonutil.dumps(config))
+    ctx.audit("group_setting_update", "security_config", {"field": key, "new": config[key]})
+    await _edit_message(
+        ctx.cb.message,
+        _render_security_settings_text(config),
+        reply_markup=kb_group_security_menu(config),
+    )
+    _spawn(ctx.cb.answer("Updated."))
+    return False
+
+
+async def _ga_toggle_enabled(ctx: _GroupAdminCtx) -> bool:
+    group = ctx.group
+    current = bool(group.get("enabled"))
+    ctx.db.set_group_enabled(ctx.group_id, not current)
+    group["enabled"] = 0 if current else 1
+    ctx.audit(
+        "group_setting_toggle",
+        "enabled",
+        {"field": "enabled", "old": current, "new": not current},
+    )
+    return True
+
+
+async def _ga_toggle(ctx: _GroupAdminCtx) -> bool:
+    group = ctx.group
+    field = ctx.arg
+    current = bool(group.get(field))
+    ctx.db.set_group_toggle(ctx.group_id, field, not current)
+    group[field] = 0 if current else 1
+    ctx.audit(
+        "group_setting_toggle",
+        field,
+        {"field": field, "old": current, "new": not current},
+    )
+    return True
+
+
+async def _ga_lang(ctx: _GroupAdminCtx) -> bool:
+    language = ctx.arg
+    if language not in _SUPPORTED_LANGUAGE_SET:
+        await ctx.cb.answer("Unknown language.")
+        return False
+    group = ctx.group
+    if group.get("language") == language:
+        ctx.notice = _NO_CHANGE_TEXT
+        return True
+    ctx.db.set_group_language(ctx.group_id, language)
+    ctx.audit(
+        "group_setting_update",
+        "language",
+        {"field": "language", "old": group.get("language"), "new": language},
+    )
+    group["language"] = language
+    return True
+
+
+async def _ga_mode(ctx: _GroupAdminCtx) -> bool:
+    mode = ctx.arg
+    if mode not in _LANGUAGE_MODE_SET:
+        await ctx.cb.answer("Unknown mode.")
+        return False
+    group = ctx.group
+    if group.get("language_mode") == mode:
+        ctx.notice = _NO_CHANGE_TEXT
+        return True
+    ctx.db.set_group_language_mode(ctx.group_id, mode)
+    ctx.audit(
+        "group_setting_update",
+        "language_mode",
+        {"field": "language_mode", "old": group.get("language_mode"), "new": mode},
+    )
+    group["language_mode"] = mode
+    return True
+
+
+async def _ga_warn(ctx: _GroupAdminCtx) -> bool:
+    try:
+        value = int(ctx.arg)
+    except ValueError:
+        await ctx.cb.answer("Invalid value.")
+        return False
+    group = ctx.group
+    mute_threshold = group.get("mute_threshold", 3)
+    if value >= mute_threshold:
+        await ctx.cb.answer("Warn threshold must be less than mute threshold.")
+        return False
+    if group.get("warn_threshold") == value:
+        ctx.notice = _NO_CHANGE_TEXT
+        return True
+    ctx.db.set_group_thresholds(ctx.group_id, value, mute_threshold)
+    ctx.audit(
+        "group_setting_update",
+        "warn_threshold",
+        {"field": "warn_threshold", "old": group.get("warn_threshold"), "new": value},
+    )
+    group["warn_threshold"] = value
+    return True
+
+
+async def _ga_mute(ctx: _GroupAdminCtx) -> bool:
+    try:
+        value = int(ctx.arg)
+    except ValueError:
+        await ctx.cb.answer("Invalid value.")
+        return False
+    group = ctx.group
+    warn_threshold = group.get("warn_threshold", 2)
+    if value <= warn_threshold:
+        await ctx.cb.answer("Mute threshold must be greater than warn threshold.")
+        return False
+    if group.get("mute_threshold") == value:
+        ctx.notice = _NO_CHANGE_TEXT
+        return True
+    ctx.db.set_group_thresholds(ctx.group_id, warn_threshold, value)
+    ctx.audit(
+        "group_setting_update",
+        "mute_threshold",
+        {"field": "mute_threshold", "old": group.get("mute_threshold"), "new": value},
+    )
+    group["mute_threshold"] = value
+    return True
+
+
+async def _ga_rag_ask(ctx: _GroupAdminCtx) -> bool:
+    if not await _require_group_rag_entitlement_cb(ctx.cb, ctx.db, ctx.group_id):
+        return False
+    data = await ctx.state.get_data()
+    window_key = data.get("rag_window", "24h")
+    filter_key = data.get("rag_filter", "incidents")
+    await ctx.state.update_data(
+        rag_group_id=ctx.group_id,
+        rag_window=window_key,
+        rag_filter=filter_key,
+    )
+    await ctx.state.set_state(Flow.waiting_for_group_rag)
+    await ctx.show_rag_menu("Send your moderation history question as a message.", window_key, filter_key)
+    await ctx.cb.answer()
+    return False
+
+
+async def _ga_rag(ctx: _GroupAdminCtx) -> bool:
+    if ctx.sub_action not in {"window", "filter", "details"}:
+        await ctx.cb.answer("Unknown action.")
+        return False
+    if not await _require_group_rag_entitlement_cb(ctx.cb, ctx.db, ctx.group_id):
+        return False
+    if ctx.sub_action == "window":
+        window_key = ctx.sub_arg
         if window_key not in RAG_WINDOWS:
-            await cb.answer("Unknown window.")
-            return
-        data = await state.get_data()
-        filter_key = data.get("rag_filter", "incidents")
-        await state.update_data(rag_window=window_key)
-        await _edit_message(
-            cb.message,
-            "Ask a question about this group's moderation history.",
-            reply_markup=kb_group_rag_menu(window_key, filter_key),
-        )
-        await cb.answer("Updated window.")
-        return
-    elif action.startswith("rag:filter:"):
-        if not await _require_group_rag_entitlement_cb(cb, db, group_id):
-            return
-        filter_key = action.split(":", 2)[2]
+            await ctx.cb.answer("Unknown window.")
+            return False
+        await ctx.state.update_data(rag_window=window_key)
+        await ctx.show_rag_menu(window_key=window_key)
+        _spawn(ctx.cb.answer("Updated window."))
+        return False
+    if ctx.sub_action == "filter":
+        filter_key = ctx.sub_arg
         if filter_key not in RAG_ACTION_FILTERS:
-            await cb.answer("Unknown filter.")
-            return
-        data = await state.get_data()
-        window_key = data.get("rag_window", "24h")
-        await state.update_data(rag_filter=filter_key)
-        await _edit_message(
-            cb.message,
-            "Ask a question about this group's moderation history.",
-            reply_markup=kb_group_rag_menu(window_key, filter_key),
-        )
-        await cb.answer("Updated filter.")
-        return
-    elif action == "rag:ask":
-        if not await _require_group_rag_entitlement_cb(cb, db, group_id):
-            return
-        data = await state.get_data()
-        window_key = data.get("rag_window", "24h")
-        filter_key = data.get("rag_filter", "incidents")
-        await state.update_data(
-            rag_group_id=group_id,
-            rag_window=window_key,
-            rag_filter=filter_key,
+            await ctx.cb.answer("Unknown filter.")
+            return False
+        await ctx.state.update_data(rag_filter=filter_key)
+        await ctx.show_rag_menu(filter_key=filter_key)
+        _spawn(ctx.cb.answer("Updated filter."))
+        return False
+
+    event = ctx.db.get_audit_event(ctx.group_id, ctx.sub_arg)
+    if not event:
+        await ctx.cb.answer("Audit record not found.")
+        return False
+    await ctx.show_rag_menu(build_audit_detail(event))
+    await ctx.cb.answer()
+    return False
+
+
+async def _ga_send_invoice(
+    ctx: _GroupAdminCtx,
+    plan,
+    plan_key: str,
+    invoice_kwargs: dict,
+    audit_action: str,
+    failure_log: str,
+) -> bool:
+    cb = ctx.cb
+    if not _should_allow_xtr_amount(plan.id, plan.stars, plan.stars, "XTR"):
+        await cb.answer(_PRICING_MISCONFIGURED_TEXT, show_alert=True)
+        return False
+    payload = _create_invoice_record(
+        db=ctx.db,
+        user_id=cb.from_user.id,
+        plan_id=plan_key,
+        amount=plan.stars,
+    )
+    if not payload:
+        await cb.answer(_INVOICE_FAILED_TEXT)
+        return False
+    logger.info(
+        "Invoice created: plan_id=%s stars_amount=%s payload_len=%s",
+        plan_key,
+        plan.stars,
+        len(payload),
+    )
+    try:
+        await ctx.bot.send_invoice(chat_id=cb.from_user.id, payload=payload, **invoice_kwargs)
+        await cb.answer("I sent you the Stars invoice in your DM.")
+        ctx.audit(audit_action, plan.id, {"plan_id": plan.id, "stars": plan.stars})
+    except Exception as exc:
+        logger.error("%s: %s", failure_log, exc)
+        await cb.answer(_INVOICE_FAILED_TEXT)
+    # The invoice toast already answered the callback; the panel itself is unchanged.
+    return False
+
+
+async def _ga_buy(ctx: _GroupAdminCtx) -> bool:
+    plan_id = ctx.arg
+    group_plan = GROUP_PLANS.get(plan_id)
+    if group_plan:
+        return await _ga_send_invoice(
+            ctx,
+            group_plan,
+            build_group_plan_key(plan_id, ctx.group_id),
+            _GROUP_INVOICES[plan_id],
+            "subscription_invoice_created",
+            "Failed to send group invoice",
         )
-        await state.set_state(Flow.waiting_for_group_rag)
-        await _edit_message(
-            cb.message,
-            "Send your moderation history question as a message.",
-            reply_markup=kb_group_rag_menu(window_key, filter_key),
+    rag_plan = RAG_ADDON_PLANS.get(plan_id)
+    if rag_plan:
+        if not require_group_entitlement(ctx.db, ctx.group_id):
+            await ctx.cb.answer(_subscription_required_notice(), show_alert=True)
+            return False
+        return await _ga_send_invoice(
+            ctx,
+            rag_plan,
+            build_rag_plan_key(plan_id, ctx.group_id),
+            _RAG_INVOICES[plan_id],
+            "rag_addon_invoice_created",
+            "Failed to send RAG add-on invoice",
         )
+    await ctx.cb.answer("Unknown plan.")
+    return False
+
+
+# Exact actions are checked first, then the first ":"-separated token.
+_GA_ACTIONS = {
+    "menu:main": _ga_menu_main,
+    "flow:cancel": _ga_flow_cancel,
+    "menu:rag": _ga_menu_rag,
+    "menu:set_welcome": partial(
+        _ga_text_prompt,
+        flow_state=Flow.waiting_for_welcome_message,
+        prompt="Send the welcome message text to save for this group.",
+    ),
+    "menu:set_rules": partial(
+        _ga_text_prompt,
+        flow_state=Flow.waiting_for_rules_text,
+        prompt="Send the rules text to save for this group.",
+    ),
+    "menu:security": _ga_menu_security,
+    "toggle_enabled": _ga_toggle_enabled,
+    "rag:ask": _ga_rag_ask,
+}
+_GA_PREFIX_ACTIONS = {
+    "security": _ga_security,
+    "toggle": _ga_toggle,
+    "lang": _ga_lang,
+    "mode": _ga_mode,
+    "warn": _ga_warn,
+    "mute": _ga_mute,
+    "rag": _ga_rag,
+    "buy": _ga_buy,
+}
+
+
+@router.callback_query(F.data.startswith("ga:"))
+async def groupadmin_handler(cb: CallbackQuery, bot: Bot, db: DB, writer: LogWriter, state: FSMContext):
+    if _is_repeat_callback(cb):
         await cb.answer()
         return
-    elif action.startswith("rag:details:"):
-        if not await _require_group_rag_entitlement_cb(cb, db, group_id):
-            return
-        event_id = action.split(":", 2)[2]
-        event = db.get_audit_event(group_id, event_id)
-        if not event:
-            await cb.answer("Audit record not found.")
-            return
-        data = await state.get_data()
-        window_key = data.get("rag_window", "24h")
-        filter_key = data.get("rag_filter", "incidents")
+    if not cb.message:
+        await cb.answer()
+        return
+
+    if cb.message.chat.type not in {"group", "supergroup"}:
+        await cb.answer("Group-only command.")
+        return
+
+    if not await is_group_admin(bot, cb.message.chat.id, cb.from_user.id):
+        await cb.answer(_ADMIN_ONLY_TEXT)
+        return
+
+    feature_enabled = _FEATURE_V2_GROUPS
+    group_id = cb.message.chat.id
+    # Any view other than the main panel replaces the message, so only the tail re-render below
+    # puts the key back.
+    panel_message_key = (group_id, cb.message.message_id)
+    last_panel_state = _groupadmin_panel_state.pop(panel_message_key, None)
+    if not feature_enabled and cb.data not in {"ga:menu:close"}:
         await _edit_message(
             cb.message,
-            build_audit_detail(event),
-            reply_markup=kb_group_rag_menu(window_key, filter_key),
+            render_groupadmin_text({}, {}, {}, False),
+            reply_markup=kb_groupadmin({}, {}, {}, False),
         )
         await cb.answer()
         return
-    elif action.startswith("buy:"):
-        plan_id = action.split(":", 1)[1]
-        if plan_id in GROUP_PLANS:
-            plan = GROUP_PLANS.get(plan_id)
-            if not plan:
-                await cb.answer("Unknown plan.")
-                return
-            if not _should_allow_xtr_amount(plan.id, plan.stars, plan.stars, "XTR"):
-                await cb.answer("Pricing misconfigured. Please contact admin.", show_alert=True)
-                return
-            plan_key = build_group_plan_key(plan_id, group_id)
-            payload = _create_invoice_record(
-                db=db,
-                user_id=cb.from_user.id,
-                plan_id=plan_key,
-                amount=plan.stars,
-            )
-            if not payload:
-                await cb.answer("Failed to create invoice. Please try again.")
-                return
-            logger.info(
-                "Invoice created: plan_id=%s stars_amount=%s payload_len=%s",
-                plan_key,
-                plan.stars,
-                len(payload),
-            )
-            duration_label = (
-                "one-time, non-refundable, lifetime access"
-                if plan.duration_days is None
-                else f"{plan.duration_days} days"
-            )
-            prices = [LabeledPrice(label=f"Group {plan.name} ({duration_label})", amount=plan.stars)]
-            try:
-                await bot.send_invoice(
-                    chat_id=cb.from_user.id,
-                    title=f"Group {plan.name} Plan",
-                    description=(
-                        "Per-group subscription. "
-                        f"Duration: {duration_label}. "
-                        "Activates paid group moderation."
-                    ),
-                    payload=payload,
-                    provider_token="",
-                    currency="XTR",
-                    prices=prices,
-                    start_parameter="resolver_group_sub",
-                    need_email=False,
-                    need_name=False,
-                    need_phone_number=False,
-                    need_shipping_address=False,
-                    is_flexible=False,
-                    disable_notification=True,
-                    protect_content=False,
-                )
-                await cb.answer("I sent you the Stars invoice in your DM.")
-                db.record_audit_event(
-                    chat_id=group_id,
-                    actor_user_id=cb.from_user.id,
-                    action="subscription_invoice_created",
-                    reason=plan_id,
-                    metadata={"plan_id": plan_id, "stars": plan.stars},
-                )
-            except Exception as exc:
-                logger.error("Failed to send group invoice: %s", exc)
-                await cb.answer("Failed to create invoice. Please try again.")
-                return
-        elif plan_id in RAG_ADDON_PLANS:
-            if not require_group_entitlement(db, group_id):
-                await cb.answer(_subscription_required_notice(), show_alert=True)
-                return
-            plan = RAG_ADDON_PLANS.get(plan_id)
-            if not plan:
-                await cb.answer("Unknown plan.")
-                return
-            if not _should_allow_xtr_amount(plan.id, plan.stars, plan.stars, "XTR"):
-                await cb.answer("Pricing misconfigured. Please contact admin.", show_alert=True)
-                return
-            plan_key = build_rag_plan_key(plan_id, group_id)
-            payload = _create_invoice_record(
-                db=db,
-                user_id=cb.from_user.id,
-                plan_id=plan_key,
-                amount=plan.stars,
-            )
-            if not payload:
-                await cb.answer("Failed to create invoice. Please try again.")
-                return
-            logger.info(
-                "Invoice created: plan_id=%s stars_amount=%s payload_len=%s",
-                plan_key,
-                plan.stars,
-                len(payload),
-            )
-            duration_label = (
-                f"{plan.duration_days} days" if plan.duration_days is not None else "lifetime"
-            )
-            prices = [LabeledPrice(label=f"{plan.name} ({duration_label})", amount=plan.stars)]
-            try:
-                await bot.send_invoice(
-                    chat_id=cb.from_user.id,
-                    title=plan.name,
-                    description=(
-                        "Per-group add-on. "
-                        f"Duration: {duration_label}. "
-                        "Requires an active group subscription."
-                    ),
-                    payload=payload,
-                    provider_token="",
-                    currency="XTR",
-                    prices=prices,
-                    start_parameter="resolver_group_rag",
-                    need_email=False,
-                    need_name=False,
-                    need_phone_number=False,
-                    need_shipping_address=False,
-                    is_flexible=False,
-                    disable_notification=True,
-                    protect_content=False,
-                )
-                await cb.answer("I sent you the Stars invoice in your DM.")
-                db.record_audit_event(
-                    chat_id=group_id,
-                    actor_user_id=cb.from_user.id,
-                    action="rag_addon_invoice_created",
-                    reason=plan_id,
-                    metadata={"plan_id": plan_id, "stars": plan.stars},
-                )
-            except Exception as exc:
-                logger.error("Failed to send RAG add-on invoice: %s", exc)
-                await cb.answer("Failed to create invoice. Please try again.")
-                return
-        else:
-            await cb.answer("Unknown plan.")
-            return
-    else:
+
+    act = _GaAction.parse(cb.data)
+    static_menu = _GA_STATIC_MENUS.get(act.action)
+    if static_menu is not None:
+        text, build_markup = static_menu
+        await _edit_message(cb.message, text, reply_markup=build_markup() if build_markup else None)
+        await cb.answer()
+        return
+
+    handler = _GA_ACTIONS.get(act.action) or _GA_PREFIX_ACTIONS.get(act.prefix)
+    if handler is None:
         await cb.answer("Unknown action.")
         return
+    ctx = _GroupAdminCtx(cb, bot, db, writer, state, group_id, act)
+    if not await handler(ctx):
+        return
 
-    group = db.get_group_settings(group_id)
-    subscription_info = db.get_group_subscription_info(group_id)
-    rag_subscription_info = db.get_group_rag_subscription_info(group_id)
-    await _edit_message(
-        cb.message,
-        render_groupadmin_text(group, subscription_info, rag_subscription_info, settings.feature_v2_groups),
-        reply_markup=kb_groupadmin(group, subscription_info, rag_subscription_info, settings.feature_v2_groups),
+    group, subscription_info, rag_subscription_info = ctx.bundle
+    panel_state = (
+        tuple(sorted(group.items())),
+        tuple(sorted(subscription_info.items())),
+        tuple(sorted(rag_subscription_info.items())),
+        feature_enabled,
+    )
+    if panel_state != last_panel_state:
+        await ctx.show_panel()
+    _groupadmin_panel_state[panel_message_key] = panel_state
+    _spawn(cb.answer(ctx.notice))
+
+
+async def _answer_groupadmin_panel(
+    msg: Message,
+    notice: str,
+    group: dict,
+    subscription_info: dict,
+    rag_subscription_info: dict,
+) -> None:
+    # The prompt replaced the panel message, so send it again with the confirmation on top:
+    # one sendMessage instead of a separate notice followed by the panel.
+    feature_enabled = _FEATURE_V2_GROUPS
+    await msg.answer(
+        f"{notice}\n\n"
+        + render_groupadmin_text(group, subscription_info, rag_subscription_info, feature_enabled),
+        reply_markup=kb_groupadmin(group, subscription_info, rag_subscription_info, feature_enabled),
     )
-    await cb.answer("Saved.")
 
 
 @router.message(Flow.waiting_for_welcome_message)
-async def on_group_welcome_message(msg: Message, state: FSMContext, bot: Bot, db: DB):
+async def on_group_welcome_message(msg: Message, state: FSMContext, bot: Bot, db: DB, writer: LogWriter):
     if msg.chat.type not in {"group", "supergroup"}:
         await msg.answer("This action can only be used in groups.")
         return
     if not await is_group_admin(bot, msg.chat.id, msg.from_user.id):
-        await msg.answer("This command is restricted to group admins.")
+        await msg.answer(_ADMIN_ONLY_TEXT)
         return
     if not msg.text:
         await msg.answer("Please send the welcome message as text.")
@@ -1686,32 +2085,27 @@ async def on_group_welcome_message(msg: Message, state: FSMContext, bot: Bot, db
         await msg.answer(f"Welcome message is too long (max {WELCOME_MAX_LENGTH} characters).")
         return
 
+    # The panel does not show the text itself, so the bundle read before the write renders it.
+    bundle = db.get_group_bundle(msg.chat.id)
     db.set_group_welcome_text(msg.chat.id, text)
-    db.record_audit_event(
+    writer.record_audit_event(
         chat_id=msg.chat.id,
         actor_user_id=msg.from_user.id,
         action="group_setting_update",
         reason="welcome_text",
         metadata={"length": len(text)},
     )
-    await msg.answer("✅ Welcome message saved.")
-    group = db.get_group_settings(msg.chat.id)
-    subscription_info = db.get_group_subscription_info(msg.chat.id)
-    rag_subscription_info = db.get_group_rag_subscription_info(msg.chat.id)
-    await msg.answer(
-        render_groupadmin_text(group, subscription_info, rag_subscription_info, settings.feature_v2_groups),
-        reply_markup=kb_groupadmin(group, subscription_info, rag_subscription_info, settings.feature_v2_groups),
-    )
+    await _answer_groupadmin_panel(msg, "✅ Welcome message saved.", *bundle)
     await state.clear()
 
 
 @router.message(Flow.waiting_for_rules_text)
-async def on_group_rules_message(msg: Message, state: FSMContext, bot: Bot, db: DB):
+async def on_group_rules_message(msg: Message, state: FSMContext, bot: Bot, db: DB, writer: LogWriter):
     if msg.chat.type not in {"group", "supergroup"}:
         await msg.answer("This action can only be used in groups.")
         return
     if not await is_group_admin(bot, msg.chat.id, msg.from_user.id):
-        await msg.answer("This command is restricted to group admins.")
+        await msg.answer(_ADMIN_ONLY_TEXT)
         return
     if not msg.text:
         await msg.answer("Please send the rules text as text.")
@@ -1728,32 +2122,27 @@ async def on_group_rules_message(msg: Message, state: FSMContext, bot: Bot, db:
         await msg.answer(f"Rules text is too long (max {RULES_MAX_LENGTH} characters).")
         return
 
+    # The panel does not show the text itself, so the bundle read before the write renders it.
+    bundle = db.get_group_bundle(msg.chat.id)
     db.set_group_rules_text(msg.chat.id, text)
-    db.record_audit_event(
+    writer.record_audit_event(
         chat_id=msg.chat.id,
         actor_user_id=msg.from_user.id,
         action="group_setting_update",
         reason="rules_text",
         metadata={"length": len(text)},
     )
-    await msg.answer("✅ Rules text saved.")
-    group = db.get_group_settings(msg.chat.id)
-    subscription_info = db.get_group_subscription_info(msg.chat.id)
-    rag_subscription_info = db.get_group_rag_subscription_info(msg.chat.id)
-    await msg.answer(
-        render_groupadmin_text(group, subscription_info, rag_subscription_info, settings.feature_v2_groups),
-        reply_markup=kb_groupadmin(group, subscription_info, rag_subscription_info, settings.feature_v2_groups),
-    )
+    await _answer_groupadmin_panel(msg, "✅ Rules text saved.", *bundle)
     await state.clear()
 
 
 @router.message(Flow.waiting_for_security_value)
-async def on_group_security_value(msg: Message, state: FSMContext, bot: Bot, db: DB):
+async def on_group_security_value(msg: Message, state: FSMContext, bot: Bot, db: DB, writer: LogWriter):
     if msg.chat.type not in {"group", "supergroup"}:
         await msg.answer("This action can only be used in groups.")
         return
     if not await is_group_admin(bot, msg.chat.id, msg.from_user.id):
-        await msg.answer("This command is restricted to group admins.")
+        await msg.answer(_ADMIN_ONLY_TEXT)
         return
     if not msg.text:
         await msg.answer("Please send a numeric value.")
@@ -1764,7 +2153,7 @@ async def on_group_security_value(msg: Message, state: FSMContext, bot: Bot, db:
 
     data = await state.get_data()
     field = data.get("security_field")
-    if field not in {"mute_seconds", "max_warnings"}:
+    if field not in _SECURITY_FIELDS:
         await msg.answer("Unknown security setting.")
         await state.clear()
         return
@@ -1786,35 +2175,31 @@ async def on_group_security_value(msg: Message, state: FSMContext, bot: Bot, db:
             await msg.answer(f"Max warnings must be between {min_val} and {max_val}.")
             return
 
-    group = db.get_group_settings(msg.chat.id)
-    config = _parse_security_config(group.get("security_config_json"))
-    config[field] = value
-    db.set_group_security_config(msg.chat.id, json.dumps(config))
-    db.record_audit_event(
-        chat_id=msg.chat.id,
-        actor_user_id=msg.from_user.id,
-        action="group_setting_update",
-        reason="security_config",
-        metadata={"field": field, "new": value},
-    )
-    await msg.answer("✅ Security settings updated.")
-    group = db.get_group_settings(msg.chat.id)
-    subscription_info = db.get_group_subscription_info(msg.chat.id)
-    rag_subscription_info = db.get_group_rag_subscription_info(msg.chat.id)
-    await msg.answer(
-        render_groupadmin_text(group, subscription_info, rag_subscription_info, settings.feature_v2_groups),
-        reply_markup=kb_groupadmin(group, subscription_info, rag_subscription_info, settings.feature_v2_groups),
-    )
+    bundle = db.get_group_bundle(msg.chat.id)
+    config = _parse_security_config(bundle[0].get("security_config_json"))
+    notice = _NO_CHANGE_TEXT
+    if config[field] != value:
+        config[field] = value
+        db.set_group_security_config(msg.chat.id, jsonutil.dumps(config))
+        writer.record_audit_event(
+            chat_id=msg.chat.id,
+            actor_user_id=msg.from_user.id,
+            action="group_setting_update",
+            reason="security_config",
+            metadata={"field": field, "new": value},
+        )
+        notice = "✅ Security settings updated."
+    await _answer_groupadmin_panel(msg, notice, *bundle)
     await state.clear()
 
 
 @router.message(Flow.waiting_for_group_rag)
-async def on_group_rag_query(msg: Message, state: FSMContext, bot: Bot, db: DB):
+async def on_group_rag_query(msg: Message, state: FSMContext, bot: Bot, db: DB, writer: LogWriter):
     if msg.chat.type not in {"group", "supergroup"}:
         await msg.answer("This query can only be used in groups.")
         return
     if not await is_group_admin(bot, msg.chat.id, msg.from_user.id):
-        await msg.answer("This command is restricted to group admins.")
+        await msg.answer(_ADMIN_ONLY_TEXT)
         return
     if not msg.text:
         await msg.answer("Please send your question as text.")
@@ -1832,7 +2217,7 @@ async def on_group_rag_query(msg: Message, state: FSMContext, bot: Bot, db: DB):
         return
 
     try:
-        db.record_audit_event(
+        writer.record_audit_event(
             chat_id=msg.chat.id,
             actor_user_id=msg.from_user.id,
             action="rag_query",
@@ -1858,7 +2243,7 @@ async def on_group_rag_query(msg: Message, state: FSMContext, bot: Bot, db: DB):
             b.adjust(2)
             markup = b.as_markup()
         if events:
-            db.record_audit_event(
+            writer.record_audit_event(
                 chat_id=msg.chat.id,
                 actor_user_id=msg.from_user.id,
                 action="rag_answer",
@@ -1867,7 +2252,7 @@ async def on_group_rag_query(msg: Message, state: FSMContext, bot: Bot, db: DB):
             )
         await msg.answer(answer, reply_markup=markup)
     except Exception:
-        logger.error("RAG query failed:\n%s", traceback.format_exc())
+        logger.exception("RAG query failed")
         await msg.answer(ERROR_MESSAGES["generic"])
     finally:
         await state.clear()
@@ -1880,7 +2265,7 @@ async def retry_menu_handler(cb: CallbackQuery):
 
 
 @router.callback_query(F.data.startswith("retry:"))
-async def retry_apply_handler(cb: CallbackQuery, db: DB):
+async def retry_apply_handler(cb: CallbackQuery, db: DB, writer: LogWriter):
     user_id = cb.from_user.id
     modifier = cb.data.split(":", 1)[1]
 
@@ -1888,8 +2273,7 @@ async def retry_apply_handler(cb: CallbackQuery, db: DB):
         await cb.answer()
         return
 
-    user = db.get_user(user_id)
-    flags = db.get_retry_flags(user_id)
+    user = await db.run(db.get_user_with_retry_flags, user_id)
 
     goal = user.get("current_goal", "").strip()
     last_text = user.get("last_input_text", "").strip()
@@ -1899,8 +2283,8 @@ async def retry_apply_handler(cb: CallbackQuery, db: DB):
         await cb.answer()
         return
 
-    if flags.get("last_resolve_was_paid") and flags.get("free_retry_available"):
-        db.set_retry_flags(user_id, last_paid=True, free_retry=False)
+    if user.get("last_resolve_was_paid") and user.get("free_retry_available"):
+        await db.run(db.set_retry_flags, user_id, last_paid=True, free_retry=False)
 
         typing_msg = await cb.message.answer("🔄 Adjusting...")
         responses = await get_llm_client().generate_responses(
@@ -1910,10 +2294,9 @@ async def retry_apply_handler(cb: CallbackQuery, db: DB):
             language=user.get("language", "en"),
             language_mode=user.get("language_mode", "clean"),
         )
-        db.log_interaction(user_id, goal, last_text, responses, used_paid=False)
+        writer.log_interaction(user_id, goal, last_text, responses, used_paid=False)
 
-        await typing_msg.delete()
-        await cb.message.answer(render_options(*responses), reply_markup=kb_after_result())
+        await _edit_or_send(typing_msg, render_options(*responses), reply_markup=kb_after_result())
         await cb.answer()
         return
 
@@ -1922,8 +2305,7 @@ async def retry_apply_handler(cb: CallbackQuery, db: DB):
         await cb.answer()
         return
 
-    if db.consume_paid_resolve(user_id):
-        db.set_retry_flags(user_id, last_paid=True, free_retry=False)
+    if await db.run(db.consume_paid_retry, user_id):
 
         typing_msg = await cb.message.answer("🔄 Adjusting...")
         responses = await get_llm_client().generate_responses(
@@ -1933,10 +2315,9 @@ async def retry_apply_handler(cb: CallbackQuery, db: DB):
             language=user.get("language", "en"),
             language_mode=user.get("language_mode", "clean"),
         )
-        db.log_interaction(user_id, goal, last_text, responses, used_paid=True)
+        writer.log_interaction(user_id, goal, last_text, responses, used_paid=True)
 
-        await typing_msg.delete()
-        await cb.message.answer(render_options(*responses), reply_markup=kb_after_result())
+        await _edit_or_send(typing_msg, render_options(*responses), reply_markup=kb_after_result())
     else:
         await cb.message.answer(ERROR_MESSAGES["no_resolves"], reply_markup=kb_pricing())
 
@@ -1952,17 +2333,18 @@ async def buy_handler(cb: CallbackQuery, bot: Bot, db: DB):
         await cb.answer("Invalid purchase option.")
         return
     if not _should_allow_xtr_amount(plan.id, plan.stars, plan.stars, "XTR"):
-        await cb.answer("Pricing misconfigured. Please contact admin.", show_alert=True)
+        await cb.answer(_PRICING_MISCONFIGURED_TEXT, show_alert=True)
         return
 
-    payload = _create_invoice_record(
+    payload = await db.run(
+        _create_invoice_record,
         db=db,
         user_id=cb.from_user.id,
         plan_id=build_personal_plan_key(plan.id),
         amount=plan.stars,
     )
     if not payload:
-        await cb.answer("Failed to create invoice. Please try again.")
+        await cb.answer(_INVOICE_FAILED_TEXT)
         return
 
     logger.info(
@@ -1971,60 +2353,54 @@ async def buy_handler(cb: CallbackQuery, bot: Bot, db: DB):
         plan.stars,
         len(payload),
     )
-    prices = [LabeledPrice(label=f"{plan.resolves} Resolves (Personal)", amount=plan.stars)]
-
     try:
         await bot.send_invoice(
             chat_id=cb.from_user.id,
-            title=f"Personal {plan.name} - The Resolver",
-            description=f"Personal (DM) plan: {plan.resolves} resolve(s).",
             payload=payload,
-            provider_token="",
-            currency="XTR",
-            prices=prices,
-            start_parameter="resolver_bot",
-            need_email=False,
-            need_name=False,
-            need_phone_number=False,
-            need_shipping_address=False,
-            is_flexible=False,
-            disable_notification=True,
-            protect_content=False,
+            **_PERSONAL_INVOICES[plan.id],
         )
         await cb.answer()
     except Exception as exc:
         logger.error("Failed to send invoice: %s", exc)
-        await cb.answer("Failed to create invoice. Please try again.")
+        await cb.answer(_INVOICE_FAILED_TEXT)
 
 
-@router.message()
-async def group_moderation_handler(msg: Message, bot: Bot, db: DB):
-    if msg.chat.type not in {"group", "supergroup"}:
-        return
-    if not msg.text or not msg.from_user:
-        return
-    if msg.text.startswith("/"):
-        return
-    if msg.from_user.is_bot:
-        return
-    if not settings.feature_v2_groups:
+# Filtered at registration: a bare message() here would also swallow private-chat updates,
+# so successful_payment and unknown_message below would never be reached.
+@router.message(
+    F.chat.type.in_({"group", "supergroup"})
+    & F.text
+    & ~F.text.startswith("/")
+    & F.from_user
+    & ~F.from_user.is_bot
+)
+async def group_moderation_handler(msg: Message, bot: Bot, db: DB, writer: LogWriter):
+    if not _FEATURE_V2_GROUPS:
         return
 
     group_id = msg.chat.id
-    group = db.get_group_settings(group_id)
-    if not group.get("enabled"):
-        return
-    if not require_group_entitlement(db, group_id):
+    # Cache hits are answered inline; misses (first message, TTL expiry, invalidation) and
+    # enabled-set reloads go to the DB pool so SQLite never runs on the event loop.
+    hit, group = db.peek_group_for_moderation(group_id)
+    if not hit:
+        group = await db.run(db.load_group_for_moderation, group_id)
+    if group is None:
+        return
+    if not group.subscription_active:
         await _maybe_notify_group_entitlement(bot, group_id)
         return
 
+    # Messages that can neither trigger nor count towards a flood skip the admin lookup.
+    trigger = detect_trigger(msg.text)
+    if not trigger and not group.security_enabled:
+        return
+    # Admins are exempt before flood tracking, so their messages never fill the flood rings.
     if await is_group_admin(bot, group_id, msg.from_user.id):
         return
 
     ts = int(msg.date.timestamp()) if msg.date else int(time.time())
-    trigger = detect_trigger(msg.text)
     flood_trigger = False
-    if group.get("security_enabled"):
+    if group.security_enabled:
         flood_trigger = detect_flood(group_id, msg.from_user.id, ts)
         if flood_trigger:
             trigger = "flood"
@@ -2032,178 +2408,103 @@ async def group_moderation_handler(msg: Message, bot: Bot, db: DB):
     if not trigger:
         return
 
-    language = group.get("language", "en")
-    language_mode = group.get("language_mode", "clean")
+    language = group.language
+    language_mode = group.language_mode
 
-    if settings.use_llm:
-        responses = await get_llm_client().generate_responses(
-            "stabilize",
-            msg.text,
-            language=language,
-            language_mode=language_mode,
-        )
-        deescalation = responses[0]
+    if _USE_LLM:
+        deescalation = await _group_deescalation(msg.text, language, language_mode, flood_trigger)
     else:
-        deescalation = (
-            GROUP_TEMPLATES["deescalate_flood"]
-            if flood_trigger
-            else GROUP_TEMPLATES["deescalate"]
-        )
+        deescalation = _TPL_DEESCALATE_FLOOD if flood_trigger else _TPL_DEESCALATE
 
     await msg.answer(deescalation)
 
-    violations = db.increment_violations(group_id, msg.from_user.id, ts)
-    warn_threshold = int(group.get("warn_threshold", 2))
-    mute_threshold = int(group.get("mute_threshold", 3))
+    violations = await db.run(db.increment_violations, group_id, msg.from_user.id, ts)
+    warn_threshold = group.warn_threshold
+    mute_threshold = group.mute_threshold
 
     action_taken = "deescalate"
     if violations == warn_threshold:
-        await msg.answer(GROUP_TEMPLATES["warn"])
+        await msg.answer(_TPL_WARN)
         action_taken = "warn"
 
     if violations >= mute_threshold:
-        if not await _bot_can_restrict(bot, group_id):
-            await msg.answer(GROUP_TEMPLATES["permission"])
-            action_taken = "mute_failed_permissions"
-        else:
+        action_taken = "mute_failed_permissions"
+        if await _bot_can_restrict(bot, group_id):
             try:
-                until_date = datetime.utcnow() + timedelta(minutes=10)
                 await bot.restrict_chat_member(
                     chat_id=group_id,
                     user_id=msg.from_user.id,
-                    permissions=ChatPermissions(can_send_messages=False),
-                    until_date=until_date,
+                    permissions=_MUTE_PERMISSIONS,
+                    until_date=int(time.time()) + MUTE_SECONDS,
                 )
-                await msg.answer(GROUP_TEMPLATES["mute"])
                 action_taken = "mute"
-                await msg.answer(GROUP_TEMPLATES["notify_admins"])
             except Exception as exc:
                 logger.error("Failed to mute user %s in group %s: %s", msg.from_user.id, group_id, exc)
-                await msg.answer(GROUP_TEMPLATES["permission"])
-                action_taken = "mute_failed_permissions"
-
-    meta_json = json.dumps(
-        {
-            "violations": violations,
-            "warn_threshold": warn_threshold,
-            "mute_threshold": mute_threshold,
-            "language": language,
-            "language_mode": language_mode,
-            "flood": flood_trigger,
-            "ai_summary": deescalation[:500],
-        }
-    )
-    db.record_moderation_log(
+                _bot_restrict_cache.pop(group_id, None)
+        # The mute (or its failure) is already decided; a failed notice must not skip the logs below.
+        try:
+            if action_taken == "mute":
+                await msg.answer(_TPL_MUTE)
+                await msg.answer(_TPL_NOTIFY_ADMINS)
+            else:
+                await msg.answer(_TPL_PERMISSION)
+        except Exception as exc:
+            logger.warning("Failed to send %s notice in group %s: %s", action_taken, group_id, exc)
+
+    meta = {
+        "violations": violations,
+        "warn_threshold": warn_threshold,
+        "mute_threshold": mute_threshold,
+        "language": language,
+        "language_mode": language_mode,
+        "flood": flood_trigger,
+        "ai_summary": deescalation[:500],
+    }
+    writer.record_moderation_log(
         group_id=group_id,
         user_id=msg.from_user.id,
         trigger=trigger,
         decision_summary=f"violations={violations}",
         action=action_taken,
-        meta_json=meta_json,
+        meta=meta,
     )
-    db.record_audit_event(
+    writer.record_audit_event(
         chat_id=group_id,
         actor_user_id=bot.id,
         target_user_id=msg.from_user.id,
         action=action_taken,
         reason=trigger,
-        metadata=json.loads(meta_json),
+        metadata=meta,
     )
 
 
-@router.pre_checkout_query()
-async def pre_checkout(pre_checkout_query: PreCheckoutQuery, db: DB):
-    try:
-        payload = pre_checkout_query.invoice_payload
-        invoice = db.get_invoice(payload)
-        if not invoice:
-            await _pre_checkout_fail(
-                pre_checkout_query, "Invoice expired or invalid. Please try again."
-            )
-            return
-
-        if invoice["status"] != "created":
-            await _pre_checkout_fail(
-                pre_checkout_query, "Invoice expired or invalid. Please try again."
-            )
-            return
+@router.chat_member()
+async def on_chat_member_updated(event: ChatMemberUpdated):
+    _admin_status_cache.pop((event.chat.id, event.new_chat_member.user.id), None)
 
-        if int(invoice["user_id"]) != pre_checkout_query.from_user.id:
-            await _pre_checkout_fail(
-                pre_checkout_query, "Invoice expired or invalid. Please try again."
-            )
-            return
 
-        now = int(time.time())
-        if now - int(invoice["created_at"]) > INVOICE_TTL_SECONDS:
-            await _pre_checkout_fail(
-                pre_checkout_query, "Invoice expired or invalid. Please try again."
-            )
-            return
+@router.my_chat_member()
+async def on_bot_member_updated(event: ChatMemberUpdated):
+    _bot_restrict_cache.pop(event.chat.id, None)
 
-        if pre_checkout_query.currency != invoice["currency"]:
-            await _pre_checkout_fail(
-                pre_checkout_query, "Invoice expired or invalid. Please try again."
-            )
-            return
 
-        total_amount = _amount_from_total(
-            pre_checkout_query.total_amount, pre_checkout_query.currency
+@router.pre_checkout_query()
+async def pre_checkout(pre_checkout_query: PreCheckoutQuery, db: DB):
+    try:
+        payload = pre_checkout_query.invoice_payload
+        invoice = await db.run(
+            db.validate_invoice,
+            payload,
+            user_id=pre_checkout_query.from_user.id,
+            currency=pre_checkout_query.currency,
+            amount=_amount_from_total(pre_checkout_query.total_amount, pre_checkout_query.currency),
+            ttl_seconds=INVOICE_TTL_SECONDS,
         )
-        if total_amount != int(invoice["amount"]):
-            await _pre_checkout_fail(
-                pre_checkout_query, "Invoice expired or invalid. Please try again."
-            )
+        reason = await _pre_checkout_reject_reason(db, invoice)
+        if reason:
+            await _pre_checkout_fail(pre_checkout_query, reason)
             return
 
-        group_info = parse_group_plan_key(str(invoice["plan_id"]))
-        if group_info:
-            plan = GROUP_PLANS.get(group_info["plan_id"])
-            if not plan or plan.stars != int(invoice["amount"]):
-                await _pre_checkout_fail(
-                    pre_checkout_query, "Invoice expired or invalid. Please try again."
-                )
-                return
-            db.ensure_group(int(group_info["group_id"]))
-            await pre_checkout_query.answer(ok=True)
-            logger.info(
-                "Pre-checkout validation: ok=%s payload=%s",
-                True,
-                payload,
-            )
-            return
-
-        rag_info = parse_rag_plan_key(str(invoice["plan_id"]))
-        if rag_info:
-            plan = RAG_ADDON_PLANS.get(rag_info["plan_id"])
-            if not plan or plan.stars != int(invoice["amount"]):
-                await _pre_checkout_fail(
-                    pre_checkout_query, "Invoice expired or invalid. Please try again."
-                )
-                return
-            if not db.group_subscription_active(int(rag_info["group_id"])):
-                await _pre_checkout_fail(
-                    pre_checkout_query, "Group subscription required for RAG."
-                )
-                return
-            db.ensure_group(int(rag_info["group_id"]))
-            await pre_checkout_query.answer(ok=True)
-            logger.info(
-                "Pre-checkout validation: ok=%s payload=%s",
-                True,
-                payload,
-            )
-            return
-
-        personal_plan_id = parse_personal_plan_key(str(invoice["plan_id"])) or str(invoice["plan_id"])
-        plan = PERSONAL_PLANS.get(personal_plan_id)
-        if not plan or plan.stars != int(invoice["amount"]):
-            await _pre_checkout_fail(
-                pre_checkout_query, "Invoice expired or invalid. Please try again."
-            )
-            return
-
-        db.ensure_user(int(invoice["user_id"]))
         await pre_checkout_query.answer(ok=True)
         logger.info(
             "Pre-checkout validation: ok=%s payload=%s",
@@ -2221,18 +2522,19 @@ async def successful_payment(msg: Message, db: DB):
 
     try:
         invoice_id = payment.invoice_payload
-        invoice = db.get_invoice(invoice_id)
+        invoice = await db.run(db.get_invoice, invoice_id)
         if not invoice:
             logger.warning("Payment received for unknown invoice %s", invoice_id)
-            await msg.answer("Payment verification failed. Please contact support.")
+            await msg.answer(PAYMENT_VERIFICATION_FAILED)
             return
 
         if int(invoice["user_id"]) != msg.from_user.id:
-            await msg.answer("Payment verification failed. Please contact support.")
+            await msg.answer(PAYMENT_VERIFICATION_FAILED)
             return
 
-        group_info = parse_group_plan_key(str(invoice["plan_id"]))
-        rag_info = parse_rag_plan_key(str(invoice["plan_id"]))
+        plan_key = str(invoice["plan_id"])
+        group_info = parse_group_plan_key(plan_key)
+        rag_info = None if group_info else parse_rag_plan_key(plan_key)
         if invoice["status"] != "created":
             if group_info:
                 await msg.answer("Payment already processed! Your group subscription is active.")
@@ -2245,27 +2547,28 @@ async def successful_payment(msg: Message, db: DB):
 
         now = int(time.time())
         if now - int(invoice["created_at"]) > INVOICE_TTL_SECONDS:
-            await msg.answer("Payment verification failed. Please contact support.")
+            await msg.answer(PAYMENT_VERIFICATION_FAILED)
             return
 
         stars_paid = _amount_from_total(payment.total_amount, payment.currency)
         if stars_paid != int(invoice["amount"]):
-            await msg.answer("Payment verification failed. Please contact support.")
+            await msg.answer(PAYMENT_VERIFICATION_FAILED)
             return
 
         if group_info:
             plan = GROUP_PLANS.get(group_info["plan_id"])
             if not plan or plan.stars != stars_paid:
                 logger.error("Group plan mismatch in payment")
-                await msg.answer("Payment processing error. Please contact support.")
+                await msg.answer(PAYMENT_PROCESSING_ERROR)
                 return
 
             transaction_id = payment.telegram_payment_charge_id
-            start_ts = int(time.time())
+            start_ts = now
             end_ts = (
                 start_ts + plan.duration_days * 86400 if plan.duration_days is not None else None
             )
-            status = db.process_group_invoice_payment(
+            status = await db.run(
+                db.process_group_invoice_payment,
                 invoice_id=invoice_id,
                 telegram_charge_id=transaction_id,
                 group_id=int(group_info["group_id"]),
@@ -2278,7 +2581,7 @@ async def successful_payment(msg: Message, db: DB):
                 await msg.answer("Payment already processed! Your group subscription is active.")
                 return
             if status != "processed":
-                await msg.answer("Payment processing error. Please contact support.")
+                await msg.answer(PAYMENT_PROCESSING_ERROR)
                 return
 
             await msg.answer(
@@ -2300,18 +2603,19 @@ async def successful_payment(msg: Message, db: DB):
             plan = RAG_ADDON_PLANS.get(rag_info["plan_id"])
             if not plan or plan.stars != stars_paid:
                 logger.error("RAG add-on mismatch in payment")
-                await msg.answer("Payment processing error. Please contact support.")
+                await msg.answer(PAYMENT_PROCESSING_ERROR)
                 return
-            if not db.group_subscription_active(int(rag_info["group_id"])):
-                await msg.answer("Payment processing error. Please contact support.")
+            if not await db.run(db.group_subscription_active, int(rag_info["group_id"])):
+                await msg.answer(PAYMENT_PROCESSING_ERROR)
                 return
 
             transaction_id = payment.telegram_payment_charge_id
-            start_ts = int(time.time())
+            start_ts = now
             end_ts = (
                 start_ts + plan.duration_days * 86400 if plan.duration_days is not None else None
             )
-            status = db.process_rag_invoice_payment(
+            status = await db.run(
+                db.process_rag_invoice_payment,
                 invoice_id=invoice_id,
                 telegram_charge_id=transaction_id,
                 group_id=int(rag_info["group_id"]),
@@ -2324,7 +2628,7 @@ async def successful_payment(msg: Message, db: DB):
                 await msg.answer("Payment already processed! Your RAG add-on is active.")
                 return
             if status != "processed":
-                await msg.answer("Payment processing error. Please contact support.")
+                await msg.answer(PAYMENT_PROCESSING_ERROR)
                 return
 
             await msg.answer(
@@ -2342,15 +2646,16 @@ async def successful_payment(msg: Message, db: DB):
             )
             return
 
-        personal_plan_id = parse_personal_plan_key(str(invoice["plan_id"])) or str(invoice["plan_id"])
+        personal_plan_id = parse_personal_plan_key(plan_key) or plan_key
         plan = PERSONAL_PLANS.get(personal_plan_id)
         if not plan:
             logger.error("Unknown plan in payment")
-            await msg.answer("Payment processing error. Please contact support.")
+            await msg.answer(PAYMENT_PROCESSING_ERROR)
             return
 
         transaction_id = payment.telegram_payment_charge_id
-        status = db.process_invoice_payment(
+        status, resolves_remaining = await db.run(
+            db.process_invoice_payment,
             invoice_id=invoice_id,
             telegram_charge_id=transaction_id,
             user_id=msg.from_user.id,
@@ -2362,14 +2667,12 @@ async def successful_payment(msg: Message, db: DB):
             await msg.answer("Payment already processed! Your resolves are available.")
             return
         if status != "processed":
-            await msg.answer("Payment processing error. Please contact support.")
+            await msg.answer(PAYMENT_PROCESSING_ERROR)
             return
 
-        user = db.get_user(msg.from_user.id)
-
         await msg.answer(
             f"✅ Payment successful! Added {plan.resolves} resolves to your account.\n\n"
-            f"You now have {user.get('resolves_remaining', 0)} resolves remaining.",
+            f"You now have {resolves_remaining or 0} resolves remaining.",
             reply_markup=kb_goals(),
         )
 
@@ -2392,10 +2695,8 @@ async def successful_payment(msg: Message, db: DB):
         )
 
 
-@router.message()
+@router.message(F.chat.type == "private")
 async def unknown_message(msg: Message):
-    if msg.chat.type != "private":
-        return
     await msg.answer(render_unknown_commands(), reply_markup=kb_goals())
 
 
@@ -9,6 +9,9 @@ from .languages import LANGUAGE_LABELS, LANGUAGE_MODE_DESCRIPTIONS
 
 logger = logging.getLogger(__name__)
 
+_OPTION_LABEL_RE = re.compile(r"^([A-C])[\.:\)]\s*")
+_LIST_SPLIT_RE = re.compile(r"\n\s*(?:\d+[\.:\)]|\-|\*|•)\s*")
+
 SYSTEM_PROMPTS = {
     "stabilize": (
         "You are The Resolver. Provide exactly 3 short response options (1-3 sentences each) "
@@ -120,6 +123,12 @@ class LLMClient:
             logger.warning("LLM generation failed; using fallback. Error: %s", exc)
             return self._generate_template_responses(goal, modifier)
 
+    def is_template_response(self, responses: List[str], goal: str, modifier: Optional[str] = None) -> bool:
+        """Whether generate_responses fell back to the canned templates for this goal."""
+        if modifier == "neutral":
+            modifier = None
+        return responses == self._generate_template_responses(goal, modifier)
+
     def _build_prompt(self, user_text: str, modifier: Optional[str] = None) -> str:
         prompt = f"Generate 3 response options for this situation:\n\n{user_text[:1000]}"
 
@@ -158,24 +167,12 @@ class LLMClient:
             if not line:
                 continue
 
-            if re.match(r"^A[\.:\)]", line):
-                if current_section is not None and current_text:
-                    responses.append(" ".join(current_text).strip())
-                current_section = "A"
-                cleaned_line = re.sub(r"^A[\.:\)]\s*", "", line)
-                current_text = [cleaned_line]
-            elif re.match(r"^B[\.:\)]", line):
-                if current_section is not None and current_text:
-                    responses.append(" ".join(current_text).strip())
-                current_section = "B"
-                cleaned_line = re.sub(r"^B[\.:\)]\s*", "", line)
-                current_text = [cleaned_line]
-            elif re.match(r"^C[\.:\)]", line):
+            label = _OPTION_LABEL_RE.match(line)
+            if label:
                 if current_section is not None and current_text:
                     responses.append(" ".join(current_text).strip())
-                current_section = "C"
-                cleaned_line = re.sub(r"^C[\.:\)]\s*", "", line)
-                current_text = [cleaned_line]
+                current_section = label.group(1)
+                current_text = [line[label.end():]]
             elif current_section is not None:
                 current_text.append(line)
 
@@ -183,7 +180,7 @@ class LLMClient:
             responses.append(" ".join(current_text).strip())
 
         if len(responses) != 3:
-            sections = re.split(r"\n\s*(?:\d+[\.:\)]|\-|\*|•)\s*", content)
+            sections = _LIST_SPLIT_RE.split(content)
             if len(sections) >= 4:
                 responses = [s.strip() for s in sections[1:4] if s.strip()]
 
@@ -203,7 +200,7 @@ class LLMClient:
 
         clean_responses = []
         for resp in responses[:3]:
-            resp = re.sub(r"^[A-C][\.:\)]\s*", "", resp).strip()
+            resp = _OPTION_LABEL_RE.sub("", resp).strip()
             clean_responses.append(resp)
 
         return clean_responses[:3]
@@ -12,9 +12,14 @@ from aiogram.types import BotCommand
 from .config import settings
 from .db import DB
 from .handlers import router
-from .middlewares import RateLimitMiddleware, CallbackLoggingMiddleware, ErrorHandlingMiddleware
+from .middlewares import (
+    CallbackLoggingMiddleware,
+    ErrorHandlingMiddleware,
+    RateLimitMiddleware,
+)
 from .pricing import GROUP_PLANS
 from .texts import ERROR_MESSAGES, BOT_COMMANDS
+from .writer import LogWriter
 
 
 def setup_logging() -> Logger:
@@ -76,7 +81,9 @@ async def main() -> None:
     storage = MemoryStorage()
     dp = Dispatcher(storage=storage)
 
+    writer = LogWriter(db)
     dp["db"] = db
+    dp["writer"] = writer
 
     dp.message.middleware(ErrorHandlingMiddleware())
     dp.message.middleware(RateLimitMiddleware())
@@ -95,11 +102,20 @@ async def main() -> None:
         await bot.set_my_commands(
             [BotCommand(command=command, description=description) for command, description in BOT_COMMANDS]
         )
-        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+        writer.start()
+        # Each update runs as its own task, so a slow LLM call in one chat never holds up
+        # moderation or menus in other chats. Handlers rely on this; keep it explicit.
+        await dp.start_polling(
+            bot,
+            allowed_updates=dp.resolve_used_update_types(),
+            handle_as_tasks=True,
+        )
     except Exception as exc:
         logger.error("Bot failed: %s", exc)
         raise
     finally:
+        await writer.close()
+        db.close()
         await bot.session.close()
         logger.info("Bot stopped")
 
@@ -1,6 +1,6 @@
 import logging
 import secrets
-from typing import Any, Optional
+from typing import Any, Dict, Optional
 
 logger = logging.getLogger(__name__)
 
@@ -2,11 +2,12 @@ import json
 import logging
 import math
 import time
-from datetime import datetime
+from functools import lru_cache
 from typing import Any, Dict, List, Optional, Tuple
 
 from openai import AsyncOpenAI
 
+from . import jsonutil
 from .config import settings
 from .db import DB
 
@@ -38,8 +39,8 @@ def _safe_text(value: Optional[str], limit: int = 160) -> str:
 
 def _safe_metadata(metadata_json: str) -> Dict[str, Any]:
     try:
-        raw = json.loads(metadata_json) if metadata_json else {}
-    except json.JSONDecodeError:
+        raw = jsonutil.loads(metadata_json) if metadata_json else {}
+    except jsonutil.JSONDecodeError:
         return {}
 
     allowed_keys = {
@@ -71,8 +72,13 @@ def _safe_metadata(metadata_json: str) -> Dict[str, Any]:
     return safe
 
 
+@lru_cache(maxsize=4096)
+def _fmt_event_minute(ts_minute: int) -> str:
+    return time.strftime("%Y-%m-%d %H:%M UTC", time.gmtime(ts_minute * 60))
+
+
 def _event_display_ts(ts: int) -> str:
-    return datetime.utcfromtimestamp(ts).strftime("%Y-%m-%d %H:%M UTC")
+    return _fmt_event_minute(ts // 60)
 
 
 def _event_to_safe_record(event: Dict[str, Any]) -> Dict[str, Any]:
@@ -246,6 +252,7 @@ async def build_rag_answer(
             "Return a concise summary with citations like [#AID:xxxx]. "
             "Do not include raw message content."
         )
+        # Indented stdlib output for the prompt; built once per query, so not worth orjson options.
         records_block = json.dumps(safe_records, ensure_ascii=False, indent=2)
         try:
             response = await client.chat.completions.create(
@@ -0,0 +1,146 @@
+"""Group message trigger detection: word lists, caps and punctuation heuristics."""
+
+import logging
+import re
+import unicodedata
+from typing import Optional
+
+try:
+    import hyperscan
+except ImportError:  # optional: needs a prebuilt libhs wheel, not available on Termux
+    hyperscan = None
+
+logger = logging.getLogger(__name__)
+
+INSULT_WORDS = frozenset({"idiot", "moron", "stupid", "dumb", "loser"})
+PROFANITY_WORDS = frozenset({"fuck", "shit", "bitch", "asshole", "bastard"})
+SLUR_WORDS = frozenset({"fag", "kike", "chink", "nigger", "tranny"})
+SELF_HARM_TAUNTS = frozenset({"kys", "kill yourself", "end yourself", "go die"})
+
+
+# Word-list triggers in priority order: (regex group name, trigger label, words).
+TRIGGER_CATEGORIES = (
+    ("self_harm", "self-harm-taunt", SELF_HARM_TAUNTS),
+    ("slur", "slur", SLUR_WORDS),
+    ("profanity", "profanity", PROFANITY_WORDS),
+    ("insult", "insult", INSULT_WORDS),
+)
+
+
+def _trie_alternation(words) -> str:
+    # Factor shared prefixes ("kys|kill yourself" -> "k(?:ill yourself|ys)") so the
+    # regex engine tries each leading character once instead of once per word.
+    trie: dict = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def render(node: dict) -> str:
+        ends = "" in node
+        branches = [re.escape(char) + render(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+        if ends:
+            return f"(?:{body})?" if len(branches) == 1 else f"{body}?"
+        return body
+
+    return render(trie)
+
+
+def _trigger_pattern(categories) -> re.Pattern:
+    groups = []
+    for name, _, words in categories:
+        groups.append(f"(?P<{name}>{_trie_alternation(words)})")
+    # Matched against casefolded text (see _fold_text), so no IGNORECASE needed.
+    return re.compile(rf"\b(?:{'|'.join(groups)})\b")
+
+
+_TRIGGER_RE = _trigger_pattern(TRIGGER_CATEGORIES)
+_TRIGGER_RANK = {name: rank for rank, (name, _, _) in enumerate(TRIGGER_CATEGORIES)}
+_TRIGGER_LABELS = tuple(label for _, label, _ in TRIGGER_CATEGORIES)
+_PUNCT_RUN_RE = re.compile(r"[!?]{3,}")
+# bytes.translate deletion tables for counting ASCII letters / uppercase in C.
+_ASCII_NON_ALPHA = bytes(c for c in range(256) if not (c < 128 and chr(c).isalpha()))
+_ASCII_NON_UPPER = bytes(c for c in range(256) if not (c < 128 and chr(c).isupper()))
+
+
+def _hs_compile():
+    # One pattern per category, id = priority rank. UTF8+UCP keeps \b Unicode-aware like re.
+    flags = hyperscan.HS_FLAG_UTF8 | hyperscan.HS_FLAG_UCP | hyperscan.HS_FLAG_SINGLEMATCH
+    patterns = [
+        rf"\b(?:{_trie_alternation(words)})\b".encode("utf-8") for _, _, words in TRIGGER_CATEGORIES
+    ]
+    database = hyperscan.Database()
+    database.compile(
+        expressions=patterns,
+        ids=list(range(len(patterns))),
+        elements=len(patterns),
+        flags=[flags] * len(patterns),
+    )
+    return database
+
+
+def _hs_on_match(rank: int, start: int, end: int, flags: int, found: list) -> None:
+    # SINGLEMATCH reports each category at most once, so this sees at most four ids.
+    found.append(rank)
+
+
+def _hs_scan(folded: str) -> Optional[int]:
+    found: list = []
+    _hs_db.scan(folded.encode("utf-8", "replace"), match_event_handler=_hs_on_match, context=found)
+    return min(found) if found else None
+
+
+_hs_db = None
+if hyperscan is not None:
+    try:
+        _hs_db = _hs_compile()
+    except Exception as exc:  # unsupported CPU or pattern; the re scanner still works
+        logger.warning("Hyperscan unavailable, using re for trigger detection: %s", exc)
+
+
+def _caps_ratio(text: str) -> float:
+    if len(text) < 10:
+        return 0.0
+    if text.isascii():
+        raw = text.encode("ascii")
+        letters = len(raw.translate(None, _ASCII_NON_ALPHA))
+        uppercase = len(raw.translate(None, _ASCII_NON_UPPER))
+    else:
+        alpha = "".join(filter(str.isalpha, text))
+        letters = len(alpha)
+        uppercase = len("".join(filter(str.isupper, alpha)))
+    if letters < 10:
+        return 0.0
+    return uppercase / letters
+
+
+def _fold_text(text: str) -> str:
+    # NFKC maps look-alikes such as fullwidth "ｆｕｃｋ" onto the plain word list;
+    # it is the identity on ASCII, which most messages are.
+    if text.isascii():
+        return text.lower()
+    return unicodedata.normalize("NFKC", text).casefold()
+
+
+def detect_trigger(text: str) -> str:
+    if _caps_ratio(text) > 0.7:
+        return "caps"
+    if _PUNCT_RUN_RE.search(text):
+        return "punctuation"
+    folded = _fold_text(text)
+    if _hs_db is not None:
+        best = _hs_scan(folded)
+        return _TRIGGER_LABELS[best] if best is not None else ""
+    # One scan over the text; keep the highest-priority category seen.
+    best = None
+    for match in _TRIGGER_RE.finditer(folded):
+        rank = _TRIGGER_RANK[match.lastgroup]
+        if best is None or rank < best:
+            best = rank
+            if rank == 0:
+                break
+    return _TRIGGER_LABELS[best] if best is not None else ""
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+from . import jsonutil
+from .db import DB
+
+logger = logging.getLogger(__name__)
+
+WRITER_BATCH_SIZE = 100
+WRITER_FLUSH_SECONDS = 0.2
+
+_MODERATION_LOG = "moderation_log"
+_INTERACTION = "interaction"
+_AUDIT_EVENT = "audit_event"
+_STOP = None
+
+
+class LogWriter:
+    """Queue append-only log rows and insert them in batches off the handler path."""
+
+    def __init__(
+        self,
+        db: DB,
+        batch_size: int = WRITER_BATCH_SIZE,
+        flush_seconds: float = WRITER_FLUSH_SECONDS,
+    ):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._queue.put_nowait(_STOP)
+            await self._task
+            self._task = None
+        while not self._queue.empty():
+            await self._flush(self._drain_nowait([]))
+
+    def record_moderation_log(
+        self,
+        group_id: int,
+        user_id: int,
+        trigger: str,
+        decision_summary: str,
+        action: str,
+        meta: Dict[str, Any],
+    ) -> None:
+        # meta is serialized by the drainer, not on the handler path.
+        row = (int(time.time()), group_id, user_id, trigger, decision_summary, action, meta)
+        self._queue.put_nowait((_MODERATION_LOG, row))
+
+    def log_interaction(
+        self,
+        user_id: int,
+        goal: str,
+        input_text: str,
+        output_options: List[str],
+        used_paid: bool,
+    ) -> None:
+        row = (user_id, goal, input_text, list(output_options), used_paid)
+        self._queue.put_nowait((_INTERACTION, row))
+
+    def record_audit_event(
+        self,
+        chat_id: int,
+        actor_user_id: int,
+        action: str,
+        target_user_id: Optional[int] = None,
+        reason: Optional[str] = None,
+        metadata: Optional[Dict[str, Any]] = None,
+    ) -> str:
+        # Id and ts are taken at enqueue time, with the same clock DB.record_audit_event uses.
+        event_id = str(uuid.uuid4())
+        row = (
+            event_id,
+            int(time.time()),
+            chat_id,
+            actor_user_id,
+            target_user_id,
+            action,
+            reason,
+            metadata or {},
+        )
+        self._queue.put_nowait((_AUDIT_EVENT, row))
+        return event_id
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while not self._stopping:
+            batch = self._take(await self._queue.get(), [])
+            deadline = loop.time() + self.flush_seconds
+            while not self._stopping and len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                self._take(item, batch)
+            await self._flush(self._drain_nowait(batch))
+
+    def _take(self, item: Optional[Tuple[str, Tuple[Any, ...]]], batch: list) -> list:
+        if item is _STOP:
+            self._stopping = True
+        else:
+            batch.append(item)
+        return batch
+
+    def _drain_nowait(self, batch: list) -> list:
+        while len(batch) < self.batch_size:
+            try:
+                item = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            self._take(item, batch)
+        return batch
+
+    async def _flush(self, batch: list) -> None:
+        if not batch:
+            return
+        moderation_rows = []
+        interaction_rows = []
+        audit_rows = []
+        for kind, row in batch:
+            if kind == _INTERACTION:
+                interaction_rows.append(row)
+                continue
+            # One bad meta dict must not take the drainer (and every later row) down with it.
+            try:
+                row = row[:-1] + (jsonutil.dumps(row[-1]),)
+            except (TypeError, ValueError) as exc:
+                logger.error("Dropping queued %s row that could not be serialized: %s", kind, exc)
+                continue
+            if kind == _MODERATION_LOG:
+                moderation_rows.append(row)
+            else:
+                audit_rows.append(row)
+        # Inserts go through the DB pool: a locked database must not stall the event loop.
+        # Each table is its own transaction, so a failure in one does not drop the others.
+        await self._insert(_MODERATION_LOG, self.db.record_moderation_logs, moderation_rows)
+        await self._insert(_INTERACTION, self.db.log_interactions, interaction_rows)
+        await self._insert(_AUDIT_EVENT, self.db.record_audit_events, audit_rows)
+
+    async def _insert(self, kind: str, insert: Any, rows: list) -> None:
+        if not rows:
+            return
+        try:
+            await self.db.run(insert, rows)
+        except Exception as exc:
+            logger.error("Dropped %s queued %s rows: %s", len(rows), kind, exc)